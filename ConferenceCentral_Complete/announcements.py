@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+announcements.py -- Udacity conference server-side Python App Engine
+    "nearly sold out" conference set behind the announcement
+
+The conferences with 1 to NEARLY_SOLD_OUT_SEATS seats left are kept in
+memcache as a dict of websafe key -> name. Writers that change a
+Conference's seatsAvailable call conferenceSeatsChanged(), which adds or
+drops just that conference when it crosses the threshold. The set is
+only rebuilt with a datastore query when it expires or is evicted (by
+one request at a time, see cache.getFresh), and by the announcement
+cron as periodic reconciliation.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+
+from cache import getFresh
+from cache import setFresh
+from cache import updateFresh
+
+NEARLY_SOLD_OUT_SEATS = 5
+NEARLY_SOLD_OUT_TTL = 2 * 60 * 60   # seconds; the hourly cron rebuilds it first
+MEMCACHE_NEARLY_SOLD_OUT_KEY = "NEARLY_SOLD_OUT"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+
+
+def isNearlySoldOut(seats):
+    """Return True if seats left put a conference in the announcement."""
+    return 0 < (seats or 0) <= NEARLY_SOLD_OUT_SEATS
+
+
+def _queryNearlySoldOut():
+    """Return nearly sold out conferences from the datastore as a dict of
+    websafe key -> name."""
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+    return dict((conf.key.urlsafe(), conf.name) for conf in confs)
+
+
+def rebuildNearlySoldOut():
+    """Query nearly sold out conferences & store them in memcache;
+    return the set as a dict of websafe key -> name."""
+    nearly_sold_out = _queryNearlySoldOut()
+    setFresh(MEMCACHE_NEARLY_SOLD_OUT_KEY, nearly_sold_out, NEARLY_SOLD_OUT_TTL)
+    return nearly_sold_out
+
+
+def getNearlySoldOut():
+    """Return nearly sold out conferences as a dict of websafe key -> name."""
+    return getFresh(MEMCACHE_NEARLY_SOLD_OUT_KEY, _queryNearlySoldOut,
+                    NEARLY_SOLD_OUT_TTL, default={})
+
+
+def formatAnnouncement(nearly_sold_out):
+    """Return the announcement text for a nearly sold out set."""
+    if not nearly_sold_out:
+        return ""
+    return ANNOUNCEMENT_TPL % ', '.join(sorted(nearly_sold_out.values()))
+
+
+def _updateSet(wsck, name):
+    """Add wsck to the memcached set with name, or drop it if name is None."""
+    def update(nearly_sold_out):
+        if name is None:
+            nearly_sold_out.pop(wsck, None)
+        else:
+            nearly_sold_out[wsck] = name
+        return nearly_sold_out
+    if not updateFresh(MEMCACHE_NEARLY_SOLD_OUT_KEY, update):
+        # not cached or too much contention; the next reader rebuilds it
+        memcache.delete(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+
+
+def conferenceSeatsChanged(conf, seats_before=None):
+    """Update the set after conf's seatsAvailable (or name) changed from
+    seats_before; deferred until commit when called in a transaction."""
+    if isNearlySoldOut(conf.seatsAvailable):
+        name = conf.name
+    elif isNearlySoldOut(seats_before):
+        name = None
+    else:
+        return
+    wsck = conf.key.urlsafe()
+    ndb.get_context().call_on_commit(lambda: _updateSet(wsck, name))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+cache.py -- Udacity conference server-side Python App Engine
+    read-through entity cache for Conference & Profile lookups
+
+Reads go to a small per-request LRU first, then to memcache, and only
+then to the datastore. Writers call invalidateEntities() with the keys
+they changed, which replaces their memcache entries with a short lived
+lock, again once a transaction commits. Readers fill memcache with
+compare-and-set, so an entity read before a write can't be stored over
+the writer's lock and outlive the write.
+
+getFresh() caches computed values such as the announcement. Only the
+request holding a short memcache lease recomputes an expired value;
+the others keep serving the stale copy meanwhile, and TTLs are jittered
+so values cached together don't expire together.
+
+"""
+
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# bump to orphan every entry written by an older entity layout
+ENTITY_CACHE_VERSION = 1
+ENTITY_CACHE_TTL = 10 * 60      # seconds
+LOCAL_CACHE_SIZE = 256          # entities per request
+ENTITY_LOCK_TTL = 32            # seconds a written key isn't refilled
+_LOCKED = 0                     # memcache value of a locked key
+
+STALE_TTL = 5 * 60              # seconds a stale value is served past its TTL
+LEASE_TTL = 10                  # seconds one request may spend recomputing
+LEASE_WAIT = 0.05               # seconds between checks for another's result
+LEASE_WAIT_POLLS = 4
+TTL_JITTER = 0.1                # TTLs vary by +-10%
+CAS_RETRIES = 5
+
+_local = threading.local()
+
+
+def _memcacheKey(key):
+    """Return versioned memcache key for an ndb.Key."""
+    return 'EC:%d:%s' % (ENTITY_CACHE_VERSION, key.urlsafe())
+
+
+def _localCache():
+    """Return the LRU for the current request, starting a new one per request."""
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if not request_id:
+        # can't tell requests apart; never share entities between them
+        return OrderedDict()
+    if getattr(_local, 'request_id', None) != request_id or \
+            not hasattr(_local, 'entities'):
+        _local.request_id = request_id
+        _local.entities = OrderedDict()
+    return _local.entities
+
+
+def _remember(key, entity):
+    """Store entity in the per-request LRU, evicting the oldest entry."""
+    entities = _localCache()
+    entities.pop(key, None)
+    entities[key] = entity
+    while len(entities) > LOCAL_CACHE_SIZE:
+        entities.popitem(last=False)
+
+
+def getCachedEntities(keys):
+    """Return entities for keys (None where missing), like ndb.get_multi."""
+    keys = list(keys)
+    # transactions must see the datastore, never a cached copy
+    if ndb.in_transaction():
+        return ndb.get_multi(keys)
+
+    entities = _localCache()
+    found = {}
+    for key in keys:
+        if key in entities:
+            found[key] = entities[key]
+            _remember(key, found[key])
+
+    missing = [key for key in set(keys) if key not in found]
+    if missing:
+        cached = memcache.get_multi([_memcacheKey(k) for k in missing])
+        for key in missing:
+            entity = cached.get(_memcacheKey(key))
+            # a locked key was just written; read it from the datastore
+            if isinstance(entity, ndb.Model):
+                found[key] = entity
+                _remember(key, entity)
+
+    missing = [key for key in missing if key not in found]
+    if missing:
+        # lock empty entries before reading the datastore; a writer
+        # relocking one in the meantime makes our cas below fail
+        cache_keys = [_memcacheKey(key) for key in missing]
+        memcache.add_multi(dict.fromkeys(cache_keys, _LOCKED),
+                           time=ENTITY_LOCK_TTL)
+        client = memcache.Client()
+        locked = client.get_multi(cache_keys, for_cas=True)
+        to_cache = {}
+        for key, entity in zip(missing, ndb.get_multi(missing)):
+            # misses are not cached; a new entity must show up at once
+            if entity is not None:
+                found[key] = entity
+                _remember(key, entity)
+                if locked.get(_memcacheKey(key)) == _LOCKED:
+                    to_cache[_memcacheKey(key)] = entity
+        if to_cache:
+            client.cas_multi(to_cache, time=ENTITY_CACHE_TTL)
+
+    return [found.get(key) for key in keys]
+
+
+def getCachedEntity(key):
+    """Return entity for key or None, like key.get()."""
+    return getCachedEntities([key])[0]
+
+
+def invalidateEntities(*keys):
+    """Drop keys from the request's LRU & lock them in memcache, again on
+    commit if in a transaction."""
+    entities = _localCache()
+    for key in keys:
+        entities.pop(key, None)
+    locks = dict.fromkeys([_memcacheKey(key) for key in keys], _LOCKED)
+    memcache.set_multi(locks, time=ENTITY_LOCK_TTL)
+    if ndb.in_transaction():
+        # a reader may have refilled memcache before the commit landed
+        ndb.get_context().call_on_commit(
+            lambda: memcache.set_multi(locks, time=ENTITY_LOCK_TTL))
+
+
+def _leaseKey(key):
+    """Return memcache key of the recompute lease for key."""
+    return 'LEASE:' + key
+
+
+def setFresh(key, value, ttl):
+    """Cache value under key for about ttl seconds, then serve it stale
+    for STALE_TTL more while it is recomputed."""
+    ttl *= random.uniform(1 - TTL_JITTER, 1 + TTL_JITTER)
+    memcache.set(key, (value, time.time() + ttl), time=int(ttl + STALE_TTL))
+
+
+def getFresh(key, recompute, ttl, default=None):
+    """Return the value cached under key; if it is missing or stale, one
+    request recomputes & caches it while the others use the stale copy,
+    or default if there is none yet."""
+    entry = memcache.get(key)
+    # values cached without setFresh() count as missing
+    if not isinstance(entry, tuple):
+        entry = None
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() < fresh_until or \
+                not memcache.add(_leaseKey(key), 1, time=LEASE_TTL):
+            return value
+    elif not memcache.add(_leaseKey(key), 1, time=LEASE_TTL):
+        # another request is recomputing; give it a moment to finish,
+        # but never pile onto the cold datastore query ourselves
+        for _ in range(LEASE_WAIT_POLLS):
+            time.sleep(LEASE_WAIT)
+            entry = memcache.get(key)
+            if isinstance(entry, tuple):
+                return entry[0]
+        return default
+
+    try:
+        value = recompute()
+        setFresh(key, value, ttl)
+    finally:
+        memcache.delete(_leaseKey(key))
+    return value
+
+
+def updateFresh(key, update):
+    """Replace the value cached under key with update(value), keeping its
+    expiry; return False if it isn't cached or kept changing under us."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(key)
+        if not isinstance(entry, tuple):
+            return False
+        value, fresh_until = entry
+        remaining = int(fresh_until - time.time() + STALE_TTL)
+        if remaining < 1:
+            return False
+        if client.cas(key, (update(value), fresh_until), time=remaining):
+            return True
+    return False
@@ -13,6 +13,7 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import logging
 from datetime import datetime
 
 import endpoints
@@ -20,12 +21,14 @@ from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
 from models import Profile
+from models import Registration
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
@@ -33,8 +36,15 @@ from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceFacetsForm
+from models import FacetCountForm
+from models import ConferenceImportResultForm
+from models import ConferenceImportResultForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import GroupRegistrationForm
+from models import AttendeeRegistrationForm
+from models import AttendeeRegistrationForms
 from models import TeeShirtSize
 
 from settings import WEB_CLIENT_ID
@@ -42,15 +52,63 @@ from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
-from utils import getUserId
+from utils import copyToFormValues
+from utils import formFieldCopier
+
+from context import currentUser
+from context import requestContext
+
+from cache import getCachedEntity
+from cache import getCachedEntities
+from cache import invalidateEntities
+
+from seats import ensureSeatShards
+from seats import makeSeatShards
+from seats import releaseSeat
+from seats import releaseSeats
+from seats import reserveSeat
+from seats import reserveSeats
+from seats import resizeSeats
+from seats import scheduleSeatReconcile
+
+from queries import cacheResult
+from queries import getCachedResult
+from queries import getQueryPlan
+from queries import invalidateQueryResults
+
+from facets import facetValues
+from facets import getFacets
+from facets import updateFacets
+
+from search import DEFAULT_SEARCH_LIMIT
+from search import MAX_SEARCH_LIMIT
+from search import documentTerms
+from search import search
+from search import updateIndex
+
+from announcements import conferenceSeatsChanged
+from announcements import formatAnnouncement
+from announcements import getNearlySoldOut
+from announcements import rebuildNearlySoldOut
+
+from confirmations import queueConfirmations
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+# entity -> form field lists & conversions, worked out once at import
+CONFERENCE_FORM_FIELDS = formFieldCopier(ConferenceForm, Conference,
+    {'startDate': str, 'endDate': str})
+# summary mode: listing fields only, loaded with projection queries; all
+# are indexed & always written, so projections never drop an entity
+CONFERENCE_SUMMARY_FIELDS = ('name', 'city', 'startDate', 'maxAttendees',
+    'seatsAvailable')
+CONFERENCE_SUMMARY_FORM_FIELDS = formFieldCopier(ConferenceForm, Conference,
+    {'startDate': str}, names=CONFERENCE_SUMMARY_FIELDS)
+PROFILE_FORM_FIELDS = formFieldCopier(ProfileForm, Profile,
+    {'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
+
 DEFAULTS = {
     "city": "Default City",
     "maxAttendees": 0,
@@ -58,32 +116,45 @@ DEFAULTS = {
     "topics": [ "Default", "Topic" ],
 }
 
-OPERATORS = {
-            'EQ':   '=',
-            'GT':   '>',
-            'GTEQ': '>=',
-            'LT':   '<',
-            'LTEQ': '<=',
-            'NE':   '!='
-            }
-
-FIELDS =    {
-            'CITY': 'city',
-            'TOPIC': 'topics',
-            'MONTH': 'month',
-            'MAX_ATTENDEES': 'maxAttendees',
-            }
+# search term weight per Conference field
+CONFERENCE_SEARCH_BOOSTS = (('name', 3), ('description', 1))
+
+MAX_GROUP_REGISTRATION = 500
+MAX_GROUP_BOOKINGS = 500        # per booker & conference, across requests
+MAX_CONFERENCE_IMPORT = 500
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# run list queries keys-only & resolve entities through the entity cache
+KEYS_ONLY_QUERIES = True
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    summary=messages.BooleanField(1),
+)
+
+CONF_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_GROUP_POST_REQUEST = endpoints.ResourceContainer(
+    GroupRegistrationForm,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -97,30 +168,41 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        values = copyToFormValues(conf, CONFERENCE_FORM_FIELDS)
+        values['websafeKey'] = conf.key.urlsafe()
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+            values['organizerDisplayName'] = displayName
+        return ConferenceForm(**values)
 
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    def _copyConferenceSummaryToForm(self, conf):
+        """Copy listing fields from (projected) Conference to ConferenceForm."""
+        values = copyToFormValues(conf, CONFERENCE_SUMMARY_FORM_FIELDS)
+        values['websafeKey'] = conf.key.urlsafe()
+        return ConferenceForm(**values)
+
+
+    def _getOrganizerNames(self, confs):
+        """Return organizer displayNames for conferences that predate the
+        denormalized organizerDisplayName, keyed by organizerUserId."""
+        organisers = set(ndb.Key(Profile, conf.organizerUserId)
+            for conf in confs if conf.organizerDisplayName is None)
+        if not organisers:
+            return {}
+        return {profile.key.id(): profile.displayName
+            for profile in getCachedEntities(organisers) if profile}
+
+
+    @staticmethod
+    def _conferenceSearchTerms(conf):
+        """Return {term: weight} indexed for conf."""
+        return documentTerms([(getattr(conf, field), boost)
+            for field, boost in CONFERENCE_SEARCH_BOOSTS])
 
+
+    def _conferenceDataFromForm(self, request):
+        """Validate ConferenceForm & return Conference properties as a dict;
+        defaults are filled into request as well."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
@@ -136,41 +218,126 @@ class ConferenceApi(remote.Service):
                 setattr(request, df, DEFAULTS[df])
 
         # convert dates from strings to Date objects; set month based on start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        try:
+            if data['startDate']:
+                data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+                data['month'] = data['startDate'].month
+            else:
+                data['month'] = 0
+            if data['endDate']:
+                data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException("Dates must be in YYYY-MM-DD format")
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        return data
+
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user, user_id = currentUser()
+
+        data = self._conferenceDataFromForm(request)
+
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
+        # (id allocation runs while the organizer profile is looked up)
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        ids_future = Conference.allocate_ids_async(size=1, parent=p_key)
+
+        # denormalize organizer's name so reads don't need the Profile
+        prof = requestContext().profile or getCachedEntity(p_key)
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            getattr(prof, 'displayName', None) or user.nickname()
+
+        c_id = ids_future.get_result()[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
+        # split seats into shards first; a Conference is only marked as
+        # sharded once its shards are stored
+        shards = makeSeatShards(c_key, data['seatsAvailable'])
+        ndb.put_multi(shards)
+        data['seatShards'] = len(shards)
+
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        conf = Conference(**data)
+        conf.put()
+        invalidateQueryResults()
+        # confirm first; the derived data below is best-effort
+        queueConfirmations(user.email(), [c_key])
+        updateFacets(after=facetValues(conf))
+        updateIndex('Conference',
+            [(c_key, None, self._conferenceSearchTerms(conf))])
+        conferenceSeatsChanged(conf)
         return request
 
 
-    @ndb.transactional()
+    def _createConferenceObjects(self, request):
+        """Create many Conferences with batched id allocation, puts & tasks."""
+        # preload necessary data items
+        user, user_id = currentUser()
+
+        if len(request.items) > MAX_CONFERENCE_IMPORT:
+            raise endpoints.BadRequestException(
+                "At most %d conferences per request." % MAX_CONFERENCE_IMPORT)
+
+        # validate every item first; bad items are reported, not fatal
+        results = [ConferenceImportResultForm(index=i) for i in range(len(request.items))]
+        valid = []
+        for i, form in enumerate(request.items):
+            try:
+                valid.append((i, form, self._conferenceDataFromForm(form)))
+            except endpoints.BadRequestException as e:
+                results[i].created = False
+                results[i].message = e.message
+        if not valid:
+            return ConferenceImportResultForms(items=results)
+
+        # one id range and one organizer lookup for the whole batch
+        p_key = ndb.Key(Profile, user_id)
+        ids_future = Conference.allocate_ids_async(size=len(valid), parent=p_key)
+        prof = requestContext().profile or getCachedEntity(p_key)
+        displayName = getattr(prof, 'displayName', None) or user.nickname()
+        first_id, _ = ids_future.get_result()
+
+        shards = []
+        confs = []
+        for c_id, (i, form, data) in enumerate(valid, first_id):
+            c_key = ndb.Key(Conference, c_id, parent=p_key)
+            data['key'] = c_key
+            data['organizerUserId'] = form.organizerUserId = user_id
+            data['organizerDisplayName'] = form.organizerDisplayName = displayName
+            conf_shards = makeSeatShards(c_key, data['seatsAvailable'])
+            data['seatShards'] = len(conf_shards)
+            shards.extend(conf_shards)
+            confs.append(Conference(**data))
+
+        # shards before conferences, as in _createConferenceObject
+        ndb.put_multi(shards)
+        ndb.put_multi(confs)
+        invalidateQueryResults()
+        queueConfirmations(user.email(), [conf.key for conf in confs])
+        updateFacets(after=[value for conf in confs for value in facetValues(conf)])
+        updateIndex('Conference', [(conf.key, None, self._conferenceSearchTerms(conf))
+            for conf in confs])
+        for conf in confs:
+            conferenceSeatsChanged(conf)
+
+        for (i, form, data), conf in zip(valid, confs):
+            results[i].created = True
+            results[i].websafeKey = conf.key.urlsafe()
+        return ConferenceImportResultForms(items=results)
+
+
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -187,12 +354,31 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        facets_before = facetValues(conf)
+        terms_before = self._conferenceSearchTerms(conf)
+        seats_before = conf.seatsAvailable
+
+        # seats live in the shards: seatsAvailable follows from them, and
+        # a new maxAttendees resizes them
+        if request.seatsAvailable not in (None, conf.seatsAvailable):
+            raise endpoints.BadRequestException(
+                "seatsAvailable can't be set; change maxAttendees instead.")
+        resized = request.maxAttendees not in (None, conf.maxAttendees)
+        if resized:
+            if request.maxAttendees < 0:
+                raise endpoints.BadRequestException(
+                    "maxAttendees can't be negative.")
+            if not resizeSeats(conf, request.maxAttendees - (conf.maxAttendees or 0)):
+                raise endpoints.BadRequestException(
+                    "maxAttendees can't be below the number of registered attendees.")
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
             # only copy fields where we get data
-            if data not in (None, []):
+            if data not in (None, []) and \
+                    field.name not in ('organizerDisplayName', 'seatsAvailable'):
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -201,8 +387,16 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        invalidateEntities(conf.key)
+        invalidateQueryResults()
+        updateFacets(before=facets_before, after=facetValues(conf))
+        updateIndex('Conference',
+            [(conf.key, terms_before, self._conferenceSearchTerms(conf))])
+        conferenceSeatsChanged(conf, seats_before)
+        if resized:
+            scheduleSeatReconcile(conf.key)
+        names = self._getOrganizerNames([conf])
+        return self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -212,6 +406,14 @@ class ConferenceApi(remote.Service):
         return self._createConferenceObject(request)
 
 
+    @endpoints.method(ConferenceForms, ConferenceImportResultForms,
+            path='conferences/import',
+            http_method='POST', name='createConferences')
+    def createConferences(self, request):
+        """Create many conferences in one request; returns per-item status."""
+        return self._createConferenceObjects(request)
+
+
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
@@ -226,81 +428,76 @@ class ConferenceApi(remote.Service):
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = getCachedEntity(ndb.Key(urlsafe=request.websafeConferenceKey))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        names = self._getOrganizerNames([conf])
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        if request.summary:
+            confs = confs.fetch(projection=CONFERENCE_SUMMARY_FIELDS)
+            return ConferenceForms(
+                items=[self._copyConferenceSummaryToForm(conf) for conf in confs]
+            )
+        if KEYS_ONLY_QUERIES:
+            confs = [conf for conf in getCachedEntities(confs.fetch(keys_only=True)) if conf]
+        else:
+            confs = confs.fetch()
+        names = self._getOrganizerNames(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId)) for conf in confs]
         )
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
-
-
-    def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
-        formatted_filters = []
-        inequality_field = None
-
-        for f in filters:
-            filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-
-            try:
-                filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
-            except KeyError:
-                raise endpoints.BadRequestException("Filter contains invalid field or operator.")
+    def _getQueryPlan(self, request):
+        """Return query plan for the submitted filters."""
+        # parsing & validation are done once per distinct filter set
+        return getQueryPlan(request.filters)
+
+
+    @endpoints.method(CONF_SEARCH_REQUEST, ConferenceForms,
+            path='conferences/search',
+            http_method='GET', name='searchConferences')
+    def searchConferences(self, request):
+        """Return conferences best matching keywords in name & description."""
+        limit = request.limit or DEFAULT_SEARCH_LIMIT
+        if limit < 1 or limit > MAX_SEARCH_LIMIT:
+            raise endpoints.BadRequestException(
+                "limit must be between 1 and %d." % MAX_SEARCH_LIMIT)
+        keys = search('Conference', request.q, limit)
+        # skip conferences deleted since they were indexed
+        confs = [conf for conf in getCachedEntities(keys) if conf]
+        names = self._getOrganizerNames(confs)
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId)) for conf in confs]
+        )
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
 
-            formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+    @endpoints.method(message_types.VoidMessage, ConferenceFacetsForm,
+            path='conferences/facets',
+            http_method='GET', name='getConferenceFacets')
+    def getConferenceFacets(self, request):
+        """Return number of conferences per city, topic & month."""
+        facets = getFacets()
+        def toForms(facet):
+            return [FacetCountForm(value=value, count=count)
+                for value, count in facets.get(facet, [])]
+        return ConferenceFacetsForm(cities=toForms('city'),
+            topics=toForms('topic'), months=toForms('month'))
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
@@ -308,54 +505,86 @@ class ConferenceApi(remote.Service):
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        """Query for conferences, one page at a time."""
+        # check requested page size; resume from cursor if one was given
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+
+        # popular filter sets are served straight from memcache
+        result, generation = getCachedResult(request)
+        if result:
+            return result
+
+        plan = self._getQueryPlan(request)
+        conferences = plan.query
+        try:
+            cursor = Cursor(urlsafe=request.websafeCursor)
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid websafeCursor.")
+        if plan.post_filters:
+            # full entities are needed to apply filters in memory
+            conferences, next_cursor, more = plan.fetchPostFilteredPage(
+                page_size, cursor)
+        # projections need an index per filter set; only the unfiltered
+        # summary listing has one declared (see index.yaml)
+        elif request.summary and not request.filters:
+            conferences, next_cursor, more = conferences.fetch_page(
+                page_size, start_cursor=cursor, projection=CONFERENCE_SUMMARY_FIELDS)
+        elif KEYS_ONLY_QUERIES:
+            # keys-only is a small op per result; entities mostly come
+            # from the entity cache
+            keys, next_cursor, more = conferences.fetch_page(
+                page_size, start_cursor=cursor, keys_only=True)
+            conferences = [conf for conf in getCachedEntities(keys) if conf]
+        else:
+            conferences, next_cursor, more = conferences.fetch_page(
+                page_size, start_cursor=cursor)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if request.summary:
+            items = [self._copyConferenceSummaryToForm(conf) for conf in conferences]
+        else:
+            # organiser displayName is stored on the conference; only older
+            # conferences without it need their profiles fetched
+            names = self._getOrganizerNames(conferences)
+            items = [self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                for conf in conferences]
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+        result = ConferenceForms(
+                items=items,
+                nextPageCursor=next_cursor.urlsafe() if more and next_cursor else None,
+                queryPlan=plan.describe()
         )
+        cacheResult(request, generation, result)
+        return result
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        values = copyToFormValues(prof, PROFILE_FORM_FIELDS)
+        values['conferenceKeysToAttend'] = self._getConferenceKeysToAttend(prof)
+        return ProfileForm(**values)
 
 
     def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
+        """Return user Profile from datastore, or a new unsaved one if
+        non-existent; it is only written once something changes it."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user, user_id = currentUser()
+        context = requestContext()
+        # a transaction (or its retry) must read the Profile afresh; an
+        # earlier attempt may have changed the request's copy
+        in_transaction = ndb.in_transaction()
+        if context.profile and not in_transaction:
+            return context.profile
 
         # get Profile from datastore
-        user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = getCachedEntity(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -364,8 +593,9 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
 
+        if not in_transaction:
+            context.profile = profile
         return profile      # return Profile
 
 
@@ -376,16 +606,28 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            oldDisplayName = prof.displayName
+            changed = False
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
-                    if val:
+                    if val and getattr(prof, field) != str(val):
                         setattr(prof, field, str(val))
+                        changed = True
                         #if field == 'teeShirtSize':
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+            # one write for all fields, none if nothing changed
+            if changed:
+                prof.put()
+                invalidateEntities(prof.key)
+
+            # copy new displayName to the user's conferences in the background
+            if prof.displayName != oldDisplayName:
+                taskqueue.add(params={'organizerUserId': prof.key.id()},
+                    url='/tasks/update_organizer_display_name'
+                )
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -405,31 +647,34 @@ class ConferenceApi(remote.Service):
         return self._doProfile(request)
 
 
+    @staticmethod
+    def _updateOrganizerDisplayName(organizerUserId):
+        """Copy organizer's current displayName onto all of their
+        conferences; used by the update_organizer_display_name task.
+        """
+        p_key = ndb.Key(Profile, organizerUserId)
+        prof = p_key.get()
+        if not prof:
+            return
+        confs = [conf for conf in Conference.query(ancestor=p_key)
+            if conf.organizerDisplayName != prof.displayName]
+        for conf in confs:
+            conf.organizerDisplayName = prof.displayName
+        ndb.put_multi(confs)
+        invalidateEntities(*[conf.key for conf in confs])
+        if confs:
+            invalidateQueryResults()
+
+
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the nearly sold out set in memcache & return the
+        Announcement; used by memcache cron job to reconcile the set
+        kept up to date by seat changes.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return formatAnnouncement(rebuildNearlySoldOut())
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
@@ -437,58 +682,189 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return StringMessage(data=formatAnnouncement(getNearlySoldOut()))
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    def _getConferenceKeysToAttend(self, prof):
+        """Return websafeConferenceKeys of conferences user is registered for."""
+        # Registration key ids are the websafeConferenceKeys, so a
+        # keys-only ancestor query is enough; profiles that have not
+        # been migrated yet still hold some in conferenceKeysToAttend
+        regs = Registration.query(ancestor=prof.key).fetch(keys_only=True)
+        return prof.conferenceKeysToAttend + [r_key.id() for r_key in regs]
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateRegistrations(p_key):
+        """Move Profile.conferenceKeysToAttend into Registration entities."""
+        prof = p_key.get()
+        if not prof.conferenceKeysToAttend:
+            return
+        regs = [Registration(key=ndb.Key(Registration, wsck, parent=p_key),
+                             conferenceKey=ndb.Key(urlsafe=wsck))
+                for wsck in prof.conferenceKeysToAttend]
+        prof.conferenceKeysToAttend = []
+        ndb.put_multi(regs + [prof])
+        invalidateEntities(p_key)
+
+
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
         prof = self._getProfileFromUser() # get user Profile
+        if prof.conferenceKeysToAttend:
+            self._migrateRegistrations(prof.key)
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = getCachedEntity(ndb.Key(urlsafe=wsck))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        if not conf.seatShards:
+            conf = ensureSeatShards(conf.key)
+
+        # neither Profile nor Conference is written; the transaction
+        # only touches the Registration and one seat shard
+        retval = self._seatRegistration(prof.key, conf, reg)
+        if retval:
+            scheduleSeatReconcile(conf.key)
+        return BooleanMessage(data=retval)
+
+
+    @ndb.transactional(xg=True)
+    def _seatRegistration(self, p_key, conf, reg):
+        """Move one seat between a Registration and a conference seat shard."""
+        retval = None
+        r_key = ndb.Key(Registration, conf.key.urlsafe(), parent=p_key)
+        registration = r_key.get()
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # take away one seat, if any are left
+            if not reserveSeat(conf):
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            # register user
+            Registration(key=r_key, conferenceKey=conf.key).put()
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                r_key.delete()
+                releaseSeat(conf)
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        return retval
+
+
+    def _groupRegistration(self, request):
+        """Register many attendees for one conference with batched RPCs."""
+        # make sure user is authed
+        user, user_id = currentUser()
+
+        # de-duplicate attendees, keeping request order for seat priority
+        attendees = []
+        for userId in request.attendeeUserIds:
+            if userId and userId not in attendees:
+                attendees.append(userId)
+        if len(attendees) > MAX_GROUP_REGISTRATION:
+            raise endpoints.BadRequestException(
+                "At most %d attendees per request." % MAX_GROUP_REGISTRATION)
+
+        wsck = request.websafeConferenceKey
+        conf = getCachedEntity(ndb.Key(urlsafe=wsck))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        if not conf.seatShards:
+            conf = ensureSeatShards(conf.key)
+
+        # anyone may book a group, e.g. an organisation its own team;
+        # bookings are recorded on the Registrations & capped per booker
+        booked_future = Registration.query(
+            Registration.conferenceKey == conf.key,
+            Registration.registeredBy == user_id).count_async()
+
+        # find who is already registered, either as a Registration or
+        # in a profile's not yet migrated conferenceKeysToAttend
+        p_keys = [ndb.Key(Profile, userId) for userId in attendees]
+        r_keys = [ndb.Key(Registration, wsck, parent=p_key) for p_key in p_keys]
+        entities = ndb.get_multi(r_keys + p_keys)
+        registrations, profiles = entities[:len(r_keys)], entities[len(r_keys):]
+        already = set(userId for userId, prof, registration
+            in zip(attendees, profiles, registrations)
+            if registration or (prof and wsck in prof.conferenceKeysToAttend))
+
+        wanted = [i for i, userId in enumerate(attendees) if userId not in already]
+        if user_id != conf.organizerUserId and \
+                booked_future.get_result() + len(wanted) > MAX_GROUP_BOOKINGS:
+            raise endpoints.ForbiddenException(
+                "At most %d attendees may be booked by one user per conference."
+                % MAX_GROUP_BOOKINGS)
+
+        # take all the seats needed in one transaction over the shards,
+        # then store every Registration in one batch
+        granted = wanted[:reserveSeats(conf, len(wanted))]
+        regs = [Registration(key=r_keys[i], conferenceKey=conf.key,
+                             registeredBy=user_id) for i in granted]
+        try:
+            ndb.put_multi(regs)
+        except datastore_errors.Error:
+            logging.exception('Registering a group for %s failed', wsck)
+
+        # reconcile seats: keep one per Registration stored as ours & give
+        # back the rest; an attendee who registered in between has their
+        # own seat, and a failed write stored nothing
+        stored = ndb.get_multi([r_keys[i] for i in granted],
+                               use_cache=False, use_memcache=False)
+        registered = set()
+        failed = set()
+        for i, registration in zip(granted, stored):
+            if registration and registration.registeredBy == user_id:
+                registered.add(i)
+            elif registration:
+                already.add(attendees[i])
+            else:
+                failed.add(i)
+        if len(registered) < len(granted):
+            releaseSeats(conf, len(granted) - len(registered))
+        if granted:
+            scheduleSeatReconcile(conf.key)
+
+        items = []
+        for i, userId in enumerate(attendees):
+            if i in registered:
+                items.append(AttendeeRegistrationForm(userId=userId,
+                    registered=True, message="Registered."))
+            elif i in failed:
+                items.append(AttendeeRegistrationForm(userId=userId,
+                    registered=False,
+                    message="Registration failed; please try again."))
+            elif userId in already:
+                items.append(AttendeeRegistrationForm(userId=userId,
+                    registered=False,
+                    message="Already registered for this conference."))
+            else:
+                items.append(AttendeeRegistrationForm(userId=userId,
+                    registered=False, message="There are no seats available."))
+        return AttendeeRegistrationForms(items=items)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -497,20 +873,14 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in self._getConferenceKeysToAttend(prof)]
+        conferences = getCachedEntities(conf_keys)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # get organizer names not yet stored on the conferences
+        names = self._getOrganizerNames(conferences)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))\
          for conf in conferences]
         )
 
@@ -531,6 +901,14 @@ class ConferenceApi(remote.Service):
         return self._conferenceRegistration(request, reg=False)
 
 
+    @endpoints.method(CONF_GROUP_POST_REQUEST, AttendeeRegistrationForms,
+            path='conference/{websafeConferenceKey}/group',
+            http_method='POST', name='registerGroupForConference')
+    def registerGroupForConference(self, request):
+        """Register a group of attendees for selected conference."""
+        return self._groupRegistration(request)
+
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
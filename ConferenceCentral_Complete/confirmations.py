@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+confirmations.py -- Udacity conference server-side Python App Engine
+    batched conference creation confirmation emails
+
+Each created conference becomes one task on the confirmation-emails pull
+queue, named after the conference so it can't be queued twice, holding
+only the organizer's email and the websafe conference key. A push task
+scheduled a few seconds later (and a cron as a safety net) leases the
+pending tasks in bulk and sends each organizer one email for all of
+their new conferences, rendered from the datastore at send time. Tasks
+are deleted once their email is sent; otherwise the lease runs out and
+the next run retries them, up to MAX_SEND_ATTEMPTS.
+
+On the dev server, mail goes to a local SMTP stand-in with
+dev_appserver.py --smtp_host=localhost --smtp_port=<port>.
+
+"""
+
+import json
+import logging
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+CONFIRMATION_QUEUE = 'confirmation-emails'
+BATCH_DELAY = 10                # seconds to gather confirmations per send
+LEASE_SECONDS = 60
+MAX_LEASED_TASKS = 500
+MAX_BATCHES = 10                # per run; the next run picks up the rest
+MAX_SEND_ATTEMPTS = 5
+MEMCACHE_CONFIRMATION_KEY = "CONFIRMATIONS_SCHEDULED"
+
+
+def _taskName(c_key):
+    """Return the pull task name for a conference's confirmation."""
+    return 'confirm-%s' % c_key.urlsafe()
+
+
+def scheduleConfirmationSend():
+    """Enqueue one send task per BATCH_DELAY."""
+    if memcache.add(MEMCACHE_CONFIRMATION_KEY, 1, time=BATCH_DELAY):
+        taskqueue.add(url='/tasks/send_confirmation_emails',
+            countdown=BATCH_DELAY
+        )
+
+
+def queueConfirmations(email, c_keys):
+    """Queue confirmation emails to email for Conference keys c_keys."""
+    tasks = [taskqueue.Task(method='PULL', name=_taskName(c_key),
+                 payload=json.dumps({'email': email,
+                                     'conference': c_key.urlsafe()}))
+             for c_key in c_keys]
+    queue = taskqueue.Queue(CONFIRMATION_QUEUE)
+    for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.DuplicateTaskNameError):
+            # already queued; the rest of the batch was still added
+            pass
+    scheduleConfirmationSend()
+
+
+def _renderConfirmation(confs):
+    """Return (subject, body) of the confirmation for confs."""
+    if len(confs) == 1:
+        subject = 'You created a new Conference!'
+    else:
+        subject = 'You created %d new Conferences!' % len(confs)
+    lines = ['Hi, you have created the following %s:' % (
+        'conference' if len(confs) == 1 else 'conferences')]
+    for conf in confs:
+        lines.append('')
+        lines.append(conf.name)
+        if conf.city:
+            lines.append('  City: %s' % conf.city)
+        if conf.startDate:
+            lines.append('  Dates: %s - %s' % (conf.startDate,
+                                                conf.endDate or conf.startDate))
+        if conf.topics:
+            lines.append('  Topics: %s' % ', '.join(conf.topics))
+        if conf.maxAttendees:
+            lines.append('  Seats: %d' % conf.maxAttendees)
+    return subject, '\r\n'.join(lines)
+
+
+def _sendBatch(tasks):
+    """Send one email per organizer for leased tasks; return the tasks
+    that are done with."""
+    done = []
+    pending = {}                # email -> {websafe key: [tasks]}
+    for task in tasks:
+        try:
+            payload = json.loads(task.payload)
+            email, wsck = payload['email'], payload['conference']
+        except (ValueError, KeyError):
+            logging.error('Dropping malformed confirmation task %s', task.name)
+            done.append(task)
+            continue
+        if task.retry_count >= MAX_SEND_ATTEMPTS:
+            logging.error('Giving up on confirmation to %s for %s', email, wsck)
+            done.append(task)
+            continue
+        # the same conference twice for one organizer is sent once
+        pending.setdefault(email, {}).setdefault(wsck, []).append(task)
+
+    wscks = list(set(wsck for by_conf in pending.values() for wsck in by_conf))
+    confs = dict(zip(wscks, ndb.get_multi([ndb.Key(urlsafe=w) for w in wscks])))
+
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    for email, by_conf in pending.items():
+        found = [confs[wsck] for wsck in sorted(by_conf) if confs[wsck]]
+        if found:
+            subject, body = _renderConfirmation(found)
+            try:
+                mail.send_mail(sender, email, subject, body)
+            except Exception:
+                # leave the tasks leased; they are retried once it expires
+                logging.exception('Sending confirmation to %s failed', email)
+                continue
+        for conf_tasks in by_conf.values():
+            done.extend(conf_tasks)
+    return done
+
+
+def sendPendingConfirmations():
+    """Lease pending confirmations in batches & send them."""
+    queue = taskqueue.Queue(CONFIRMATION_QUEUE)
+    for _ in range(MAX_BATCHES):
+        tasks = queue.lease_tasks(LEASE_SECONDS, MAX_LEASED_TASKS)
+        if not tasks:
+            return
+        done = _sendBatch(tasks)
+        for start in range(0, len(done), taskqueue.MAX_TASKS_PER_ADD):
+            queue.delete_tasks(done[start:start + taskqueue.MAX_TASKS_PER_ADD])
+        if len(tasks) < MAX_LEASED_TASKS:
+            return
+    # more left than one run sends; keep going in a new task
+    scheduleConfirmationSend()
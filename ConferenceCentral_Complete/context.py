@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+context.py -- Udacity conference server-side Python App Engine
+    per-request user identity shared by ConferenceApi helpers
+
+endpoints.get_current_user() and getUserId() may each cost a token
+check or an RPC. currentUser() resolves them once per request and every
+helper reuses the result, along with the caller's Profile once one
+helper has loaded it.
+
+"""
+
+import os
+import threading
+
+import endpoints
+
+from utils import getUserId
+
+_local = threading.local()
+
+
+class RequestContext(object):
+    """RequestContext -- signed in user, user id & Profile of one request"""
+
+    def __init__(self):
+        self.user = endpoints.get_current_user()
+        self.userId = getUserId(self.user) if self.user else None
+        self.profile = None     # set by the first helper that loads it
+
+
+def requestContext():
+    """Return the RequestContext of the current request."""
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if not request_id:
+        # can't tell requests apart; never share identity between them
+        return RequestContext()
+    # the credentials are part of the key, so a context is only ever
+    # reused for the same caller
+    key = (request_id, os.environ.get('HTTP_AUTHORIZATION'))
+    if getattr(_local, 'key', None) != key:
+        _local.key = key
+        _local.context = RequestContext()
+    return _local.context
+
+
+def currentUser():
+    """Return (user, user id) of the signed in caller; raise
+    UnauthorizedException if there is none."""
+    context = requestContext()
+    if not context.user:
+        raise endpoints.UnauthorizedException('Authorization required')
+    return context.user, context.userId
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- Udacity conference server-side Python App Engine
+    Conference counts per city, topic & month for the browse UI
+
+Counts live in FacetCount root entities, one per facet value, so
+reading every facet is a single small query instead of a scan of the
+Conference kind. Conference writers pass the facet values a conference
+had before and after the write to updateFacets(); the counts change
+once the write commits. Count updates are best-effort: a failed one is
+logged rather than failing the already stored write, and a daily task
+rebuilds all counts from the Conference kind to repair the drift.
+
+"""
+
+import logging
+from collections import Counter
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import FacetCount
+
+# Conference property -> facet name
+FACETS = {
+            'city': 'city',
+            'topics': 'topic',
+            'month': 'month',
+            }
+
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+FACETS_TTL = 10 * 60            # seconds
+REBUILD_BATCH_SIZE = 500
+
+
+def _countKey(facet, value):
+    """Return the FacetCount key for one facet value."""
+    return ndb.Key(FacetCount, '%s:%s' % (facet, value))
+
+
+def facetValues(conf):
+    """Return (facet, value) pairs conf is counted under."""
+    values = set()
+    for prop, facet in FACETS.items():
+        prop_values = getattr(conf, prop)
+        if not isinstance(prop_values, list):
+            prop_values = [prop_values]
+        for value in prop_values:
+            # month 0 means no start date
+            if value:
+                values.add((facet, unicode(value)))
+    return values
+
+
+@ndb.transactional_tasklet
+def _addToCount(facet, value, delta):
+    """Add delta to one facet value's count, dropping it at zero."""
+    key = _countKey(facet, value)
+    count = yield key.get_async()
+    if count is None:
+        count = FacetCount(key=key, facet=facet, value=value)
+    count.count += delta
+    if count.count > 0:
+        yield count.put_async()
+    else:
+        yield key.delete_async()
+
+
+def _applyDeltas(deltas):
+    """Write count changes, one small transaction per facet value; log
+    the ones that fail."""
+    futures = [((facet, value), _addToCount(facet, value, delta))
+               for (facet, value), delta in deltas.items() if delta]
+    for (facet, value), future in futures:
+        try:
+            future.get_result()
+        except Exception:
+            # the conference is stored already; rebuildFacets() repairs this
+            logging.exception('Updating facet count %s:%s failed', facet, value)
+    if futures:
+        memcache.delete(MEMCACHE_FACETS_KEY)
+
+
+def updateFacets(before=(), after=()):
+    """Move counts from the (facet, value) pairs in before to those in
+    after; deferred until commit when called inside a transaction."""
+    deltas = Counter(after)
+    deltas.subtract(before)
+    ndb.get_context().call_on_commit(lambda: _applyDeltas(deltas))
+
+
+def getFacets():
+    """Return {facet: [(value, count)]}, most common values first."""
+    facets = memcache.get(MEMCACHE_FACETS_KEY)
+    if facets is None:
+        facets = dict((facet, []) for facet in FACETS.values())
+        for count in FacetCount.query().fetch():
+            facets.setdefault(count.facet, []).append((count.value, count.count))
+        for values in facets.values():
+            values.sort(key=lambda item: (-item[1], item[0]))
+        memcache.set(MEMCACHE_FACETS_KEY, facets, time=FACETS_TTL)
+    return facets
+
+
+def rebuildFacets():
+    """Recount every facet value from the Conference kind."""
+    counts = Counter()
+    for conf in Conference.query().iter(batch_size=REBUILD_BATCH_SIZE):
+        counts.update(facetValues(conf))
+
+    stale = set(FacetCount.query().fetch(keys_only=True))
+    entities = []
+    for (facet, value), count in counts.items():
+        key = _countKey(facet, value)
+        stale.discard(key)
+        entities.append(FacetCount(key=key, facet=facet, value=value, count=count))
+    ndb.put_multi(entities)
+    ndb.delete_multi(stale)
+    memcache.delete(MEMCACHE_FACETS_KEY)
+    logging.info('Rebuilt %d facet counts from conferences', len(entities))
@@ -15,7 +15,12 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from seats import reconcileSeats
+from facets import rebuildFacets
+from search import applyQueuedChanges
+from confirmations import sendPendingConfirmations
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -26,7 +31,8 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation; only drains tasks
+        queued before confirmations were batched."""
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -38,7 +44,48 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Send batched emails confirming Conference creation."""
+        sendPendingConfirmations()
+
+    def get(self):
+        """Send confirmation emails left over by failed batches (cron)."""
+        sendPendingConfirmations()
+
+
+class UpdateOrganizerDisplayNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy organizer's displayName onto their Conferences."""
+        ConferenceApi._updateOrganizerDisplayName(
+            self.request.get('organizerUserId'))
+
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Sum a Conference's seat shards into seatsAvailable."""
+        reconcileSeats(ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+
+
+class RebuildFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Recount conferences per city, topic & month."""
+        rebuildFacets()
+        self.response.set_status(204)
+
+
+class UpdateSearchIndexHandler(webapp2.RequestHandler):
+    def post(self):
+        """Retry search term updates that failed during a write."""
+        applyQueuedChanges(self.request.body)
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/send_confirmation_emails', SendConfirmationEmailsHandler),
+    ('/tasks/update_organizer_display_name', UpdateOrganizerDisplayNameHandler),
+    ('/tasks/reconcile_seats', ReconcileSeatsHandler),
+    ('/crons/rebuild_facets', RebuildFacetsHandler),
+    ('/tasks/update_search_index', UpdateSearchIndexHandler),
 ], debug=True)
@@ -26,7 +26,19 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True) # legacy; see Registration
+
+class Registration(ndb.Model):
+    """Registration -- Profile attending a Conference; child of the
+    Profile, keyed by websafeConferenceKey"""
+    conferenceKey   = ndb.KeyProperty(kind='Conference', required=True)
+    registeredBy    = ndb.StringProperty()  # user id of a group booker
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class EmailUserId(ndb.Model):
+    """EmailUserId -- user id for the "custom" id_type, keyed by
+    normalized email"""
+    userId          = ndb.StringProperty(required=True, indexed=False)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -60,6 +72,22 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False) # copy of Profile.displayName
+    seatShards      = ndb.IntegerProperty(default=0, indexed=False) # 0 = not sharded yet
+
+class SeatShard(ndb.Model):
+    """SeatShard -- slice of a Conference's available seats"""
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
+
+class SearchTerm(ndb.Model):
+    """SearchTerm -- search postings of one term for one kind"""
+    postings        = ndb.JsonProperty(compressed=True) # websafe key -> weight
+
+class FacetCount(ndb.Model):
+    """FacetCount -- number of Conferences with one city, topic or month"""
+    facet           = ndb.StringProperty(required=True)
+    value           = ndb.StringProperty(required=True)
+    count           = ndb.IntegerProperty(default=0, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -79,6 +107,44 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageCursor = messages.StringField(2)
+    queryPlan = messages.StringField(3)
+
+class ConferenceImportResultForm(messages.Message):
+    """ConferenceImportResultForm -- outbound result for one imported Conference"""
+    index           = messages.IntegerField(1, variant=messages.Variant.INT32)
+    created         = messages.BooleanField(2)
+    websafeKey      = messages.StringField(3)
+    message         = messages.StringField(4)
+
+class ConferenceImportResultForms(messages.Message):
+    """ConferenceImportResultForms -- multiple ConferenceImportResultForm outbound form message"""
+    items = messages.MessageField(ConferenceImportResultForm, 1, repeated=True)
+
+class GroupRegistrationForm(messages.Message):
+    """GroupRegistrationForm -- inbound list of attendees to register"""
+    attendeeUserIds = messages.StringField(1, repeated=True)
+
+class AttendeeRegistrationForm(messages.Message):
+    """AttendeeRegistrationForm -- outbound registration result for one attendee"""
+    userId          = messages.StringField(1)
+    registered      = messages.BooleanField(2)
+    message         = messages.StringField(3)
+
+class AttendeeRegistrationForms(messages.Message):
+    """AttendeeRegistrationForms -- multiple AttendeeRegistrationForm outbound form message"""
+    items = messages.MessageField(AttendeeRegistrationForm, 1, repeated=True)
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- outbound number of Conferences for one facet value"""
+    value           = messages.StringField(1)
+    count           = messages.IntegerField(2, variant=messages.Variant.INT32)
+
+class ConferenceFacetsForm(messages.Message):
+    """ConferenceFacetsForm -- outbound Conference counts per city, topic & month"""
+    cities = messages.MessageField(FacetCountForm, 1, repeated=True)
+    topics = messages.MessageField(FacetCountForm, 2, repeated=True)
+    months = messages.MessageField(FacetCountForm, 3, repeated=True)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -107,4 +173,7 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    websafeCursor = messages.StringField(3)
+    summary = messages.BooleanField(4) # only listing fields; see CONFERENCE_SUMMARY_FIELDS
 
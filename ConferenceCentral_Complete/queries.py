@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+queries.py -- Udacity conference server-side Python App Engine
+    compiled & cached query plans for queryConferences
+
+User supplied filters are parsed, validated and type-coerced once per
+distinct filter set; the resulting plan, including its ready-to-run
+ndb.Query, is kept in a small in-process LRU. Plans are also checked
+against the composite indexes declared in index.yaml so unsupported
+filter combinations fail with a 400 before reaching the datastore.
+
+A NE filter runs in the datastore as two inequality sub-queries merged
+in memory, and takes up the query's single inequality & first sort
+order. When a plan has other filters to narrow the indexed query, NE
+filters are instead applied in memory to the results of that query.
+
+The datastore allows inequalities on a single property only. When a
+plan has range filters on several fields, the most selective field
+that a declared index can serve runs in the datastore and the rest are
+applied in memory, the same way as NE filters.
+
+Whole queryConferences responses are cached in memcache under the
+normalized filter set, page size & cursor, tagged with a generation
+counter; any write that changes listed conferences bumps the counter
+through invalidateQueryResults(), orphaning every cached page at once.
+
+"""
+
+import hashlib
+import logging
+import operator
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+
+OPERATORS = {
+            'EQ':   '=',
+            'GT':   '>',
+            'GTEQ': '>=',
+            'LT':   '<',
+            'LTEQ': '<=',
+            'NE':   '!='
+            }
+
+FIELDS =    {
+            'CITY': 'city',
+            'TOPIC': 'topics',
+            'MONTH': 'month',
+            'MAX_ATTENDEES': 'maxAttendees',
+            }
+
+INTEGER_FIELDS = ('month', 'maxAttendees')
+
+# in-memory filter operations, same semantics as the datastore's
+COMPARISONS = {
+            '=':    operator.eq,
+            '>':    operator.gt,
+            '>=':   operator.ge,
+            '<':    operator.lt,
+            '<=':   operator.le,
+            '!=':   operator.ne,
+            }
+
+QUERY_PLAN_CACHE_SIZE = 500
+POST_FILTER_BATCH_SIZE = 100
+MAX_POST_FILTER_SCAN = 1000     # entities read per page at most
+QUERY_RESULT_TTL = 60           # seconds; generation bumps do the real work
+MEMCACHE_QUERY_GENERATION_KEY = "QUERY_CONFERENCES_GEN"
+MEMCACHE_QUERY_RESULT_KEY = "QUERY_CONFERENCES_%s"
+INDEX_YAML = os.path.join(os.path.dirname(__file__), 'index.yaml')
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+_indexes = None
+
+
+class QueryPlan(object):
+    """QueryPlan -- validated filters & ready-to-run query for one filter set"""
+
+    def __init__(self, inequality_field, filters, post_filters=()):
+        self.inequality_field = inequality_field
+        self.filters = filters              # (field, operator, value), run in datastore
+        self.post_filters = post_filters    # (field, operator, value), run in memory
+        self.query = self._buildQuery()
+
+    def _buildQuery(self):
+        """Return ndb.Query for the plan's filters."""
+        q = Conference.query()
+
+        # If exists, sort on inequality filter first
+        if not self.inequality_field:
+            q = q.order(Conference.name)
+        else:
+            q = q.order(ndb.GenericProperty(self.inequality_field))
+            q = q.order(Conference.name)
+
+        for field, op, value in self.filters:
+            q = q.filter(ndb.query.FilterNode(field, op, value))
+
+        # != runs as merged sub-queries, which only support cursors when
+        # ordered by key last; indexes already end in __key__
+        if any(op == '!=' for f, op, v in self.filters):
+            q = q.order(Conference.key)
+        return q
+
+    def requiredIndex(self):
+        """Return (equality fields, sort fields) of the composite index the
+        plan needs, or None if built-in indexes suffice."""
+        equality = frozenset(f for f, op, v in self.filters if op == '=')
+        sort = ((self.inequality_field,) if self.inequality_field else ()) + \
+            ('name',)
+        if not equality and sort == ('name',):
+            return None
+        return (equality, sort)
+
+    def describe(self):
+        """Return a short description of how the plan runs."""
+        if not self.filters:
+            description = 'scan by name'
+        else:
+            description = 'index: ' + ', '.join(
+                '%s %s %s' % f for f in self.filters)
+        if any(op == '!=' for f, op, v in self.filters):
+            description += ' (!= merged from 2 sub-queries)'
+        if self.post_filters:
+            description += '; in memory: ' + ', '.join(
+                '%s %s %s' % f for f in self.post_filters)
+        return description
+
+    def matches(self, entity):
+        """Return True if entity passes all post_filters."""
+        for field, op, value in self.post_filters:
+            values = getattr(entity, field)
+            if not isinstance(values, list):
+                values = [] if values is None else [values]
+            # like the datastore, a repeated property matches if any value does
+            if not any(COMPARISONS[op](v, value) for v in values):
+                return False
+        return True
+
+    def fetchPostFilteredPage(self, page_size, cursor):
+        """Return (entities, next cursor, more) for one page of the plan,
+        reading the indexed query in batches & applying post_filters."""
+        it = self.query.iter(start_cursor=cursor, produce_cursors=True,
+                             batch_size=POST_FILTER_BATCH_SIZE)
+        results = []
+        scanned = 0
+        for entity in it:
+            scanned += 1
+            if self.matches(entity):
+                results.append(entity)
+            # stop on a full page, or a short one if matches are sparse
+            if len(results) == page_size or scanned == MAX_POST_FILTER_SCAN:
+                return results, it.cursor_after(), it.probably_has_next()
+        return results, None, False
+
+
+def _formatFilters(filters):
+    """Parse, check validity and format user supplied filters."""
+    formatted_filters = []
+
+    for f in filters:
+        try:
+            field = FIELDS[f.field]
+            op = OPERATORS[f.operator]
+        except KeyError:
+            raise endpoints.BadRequestException("Filter contains invalid field or operator.")
+
+        value = f.value
+        if field in INTEGER_FIELDS:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException(
+                    "Filter value for %s must be an integer." % f.field)
+
+        formatted_filters.append((field, op, value))
+    return tuple(formatted_filters)
+
+
+def _selectivity(field, filters):
+    """Return a sort key ranking how much field's range filters are
+    expected to narrow a query; higher is narrower."""
+    ops = [op for f, op, v in filters if f == field]
+    # a closed range beats a single bound
+    lower = any(op in ('>', '>=') for op in ops)
+    upper = any(op in ('<', '<=') for op in ops)
+    return (lower + upper, len(ops))
+
+
+def _planFilters(formatted_filters):
+    """Split filters between datastore & memory; return a QueryPlan."""
+    ne_filters = tuple(f for f in formatted_filters if f[1] == '!=')
+    filters = tuple(f for f in formatted_filters if f[1] != '!=')
+
+    if ne_filters and not filters and len(ne_filters) == 1:
+        # != on its own: let the datastore merge its two sub-queries
+        return QueryPlan(ne_filters[0][0], ne_filters)
+    # the other filters narrow the indexed query; check != in memory
+    post_filters = ne_filters
+
+    equality = tuple(f for f in filters if f[1] == '=')
+    ranges = tuple(f for f in filters if f[1] != '=')
+    if not ranges:
+        return QueryPlan(None, equality, post_filters)
+
+    # only one field can take inequalities in the datastore: push the
+    # narrowest one that has an index, check the others in memory
+    candidates = sorted(set(f for f, op, v in ranges),
+                        key=lambda field: _selectivity(field, ranges),
+                        reverse=True)
+    plans = [QueryPlan(field,
+                       equality + tuple(f for f in ranges if f[0] == field),
+                       tuple(f for f in ranges if f[0] != field) + post_filters)
+             for field in candidates]
+    for plan in plans:
+        if _hasIndex(plan):
+            return plan
+    return plans[0]
+
+
+def _loadIndexes():
+    """Return declared Conference composite indexes from index.yaml as a
+    set of (equality fields, sort fields), or None if they can't be read."""
+    try:
+        import yaml
+        with open(INDEX_YAML) as f:
+            declared = yaml.safe_load(f).get('indexes') or []
+    except Exception:
+        logging.warning('Could not load %s; skipping index checks', INDEX_YAML)
+        return None
+
+    indexes = set()
+    for index in declared:
+        # ancestor indexes can't serve queryConferences
+        if index.get('kind') != 'Conference' or index.get('ancestor'):
+            continue
+        names = [p['name'] for p in index.get('properties', [])]
+        # an index serves any query whose sort orders are its trailing
+        # properties and whose equality filters are the rest
+        for split in range(len(names)):
+            indexes.add((frozenset(names[:split]), tuple(names[split:])))
+    return indexes
+
+
+def _hasIndex(plan):
+    """Return True if a declared index can serve plan, or if indexes
+    aren't checked."""
+    global _indexes
+    # dev_appserver creates missing indexes itself; only check deployed apps
+    if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+        return True
+    if _indexes is None:
+        _indexes = _loadIndexes() or frozenset()
+    required = plan.requiredIndex()
+    return not (required and _indexes and required not in _indexes)
+
+
+def _checkIndexes(plan):
+    """Raise BadRequestException if no declared index can serve plan."""
+    if not _hasIndex(plan):
+        raise endpoints.BadRequestException(
+            "This combination of filters is not supported.")
+
+
+def getQueryPlan(filters):
+    """Return the cached QueryPlan for ConferenceQueryForm filters,
+    compiling & validating it on first use."""
+    key = tuple(sorted((f.field, f.operator, f.value) for f in filters))
+    with _plans_lock:
+        plan = _plans.pop(key, None)
+        if plan is not None:
+            _plans[key] = plan
+            return plan
+
+    plan = _planFilters(_formatFilters(filters))
+    _checkIndexes(plan)
+    logging.debug('queryConferences plan: %s', plan.describe())
+
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > QUERY_PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
+
+
+def _resultKey(request):
+    """Return memcache key for a ConferenceQueryForms request."""
+    normalized = (
+        tuple(sorted((f.field, f.operator, f.value) for f in request.filters)),
+        request.pageSize, request.websafeCursor, bool(request.summary))
+    return MEMCACHE_QUERY_RESULT_KEY % hashlib.md5(repr(normalized)).hexdigest()
+
+
+def getCachedResult(request):
+    """Return cached ConferenceForms for request and current generation;
+    returns (result or None, generation)."""
+    key = _resultKey(request)
+    cached = memcache.get_multi([MEMCACHE_QUERY_GENERATION_KEY, key])
+    generation = cached.get(MEMCACHE_QUERY_GENERATION_KEY)
+    if generation is None:
+        # start above any generation used before the counter was evicted
+        generation = int(time.time() * 1000)
+        if not memcache.add(MEMCACHE_QUERY_GENERATION_KEY, generation):
+            return None, memcache.get(MEMCACHE_QUERY_GENERATION_KEY)
+    entry = cached.get(key)
+    if entry and entry[0] == generation:
+        return entry[1], generation
+    return None, generation
+
+
+def cacheResult(request, generation, result):
+    """Store ConferenceForms for request, tagged with the generation that
+    was current before the query ran."""
+    if generation is not None:
+        memcache.set(_resultKey(request), (generation, result),
+                     time=QUERY_RESULT_TTL)
+
+
+def _bumpGeneration():
+    memcache.incr(MEMCACHE_QUERY_GENERATION_KEY,
+                  initial_value=int(time.time() * 1000))
+
+
+def invalidateQueryResults():
+    """Orphan all cached queryConferences results; deferred until commit
+    when called inside a transaction."""
+    ndb.get_context().call_on_commit(_bumpGeneration)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+seats.py -- Udacity conference server-side Python App Engine
+    sharded seat counter for conference registration
+
+A Conference's free seats are split across SeatShard root entities so
+registrations for one conference touch different entity groups and can
+commit in parallel. A shard never goes below zero, so the shards
+together can never hand out more than maxAttendees seats.
+Conference.seatsAvailable is kept as the reconciled total, rewritten by
+a deferred task a few seconds after registrations change the shards;
+that rewrite also keeps the nearly sold out announcement set current.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+from cache import invalidateEntities
+
+from queries import invalidateQueryResults
+
+from announcements import conferenceSeatsChanged
+
+# keep (shards + profile) well inside the 25 entity group xg limit
+MAX_SEAT_SHARDS = 20
+RECONCILE_DELAY = 5             # seconds
+MEMCACHE_RECONCILE_KEY = "SEATS_RECONCILE_%s"
+
+
+def _shardKey(c_key, index):
+    """Return the key of shard index for Conference key c_key."""
+    return ndb.Key(SeatShard, '%s:%d' % (c_key.urlsafe(), index))
+
+
+def makeSeatShards(c_key, seats):
+    """Return unsaved SeatShards splitting seats for Conference key c_key."""
+    num_shards = max(1, min(MAX_SEAT_SHARDS, seats))
+    per_shard, extra = divmod(seats, num_shards)
+    return [SeatShard(key=_shardKey(c_key, i),
+                      seatsAvailable=per_shard + (1 if i < extra else 0))
+            for i in range(num_shards)]
+
+
+@ndb.transactional(xg=True)
+def ensureSeatShards(c_key):
+    """Shard the seats of a Conference created before seat sharding."""
+    conf = c_key.get()
+    if not conf.seatShards:
+        shards = makeSeatShards(c_key, conf.seatsAvailable or 0)
+        conf.seatShards = len(shards)
+        ndb.put_multi(shards + [conf])
+        invalidateEntities(c_key)
+    return conf
+
+
+@ndb.non_transactional
+def _shardsWithSeats(conf):
+    """Return keys of conf's shards that had free seats, in random order.
+    Reads outside any transaction, so the shards don't join it.
+    """
+    keys = [_shardKey(conf.key, i) for i in range(conf.seatShards)]
+    shards = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+    keys = [key for key, shard in zip(keys, shards)
+            if shard and shard.seatsAvailable > 0]
+    random.shuffle(keys)
+    return keys
+
+
+def reserveSeat(conf):
+    """Take one seat from any non-empty shard; return False if sold out.
+    Must run inside an xg transaction.
+    """
+    # every get() inside the transaction enlists that shard's entity
+    # group, so only the shard we take from is read transactionally
+    for s_key in _shardsWithSeats(conf):
+        shard = s_key.get()
+        if shard and shard.seatsAvailable > 0:
+            shard.seatsAvailable -= 1
+            shard.put()
+            return True
+    return False
+
+
+@ndb.transactional(xg=True)
+def reserveSeats(conf, count):
+    """Take up to count seats across all shards in one transaction;
+    return how many were taken.
+    """
+    shards = ndb.get_multi(
+        [_shardKey(conf.key, i) for i in range(conf.seatShards)])
+    taken = 0
+    changed = []
+    for shard in shards:
+        if taken == count:
+            break
+        if shard and shard.seatsAvailable > 0:
+            take = min(shard.seatsAvailable, count - taken)
+            shard.seatsAvailable -= take
+            taken += take
+            changed.append(shard)
+    ndb.put_multi(changed)
+    return taken
+
+
+def releaseSeat(conf):
+    """Give one seat back to a random shard. Must run inside an xg transaction."""
+    s_key = _shardKey(conf.key, random.randrange(conf.seatShards))
+    shard = s_key.get() or SeatShard(key=s_key, seatsAvailable=0)
+    shard.seatsAvailable += 1
+    shard.put()
+
+
+@ndb.transactional(xg=True)
+def releaseSeats(conf, count):
+    """Give count seats back, spread over the shards."""
+    keys = [_shardKey(conf.key, i) for i in range(conf.seatShards)]
+    shards = [shard or SeatShard(key=key, seatsAvailable=0)
+              for key, shard in zip(keys, ndb.get_multi(keys))]
+    for i in range(count):
+        shards[i % len(shards)].seatsAvailable += 1
+    ndb.put_multi(shards[:count])
+
+
+@ndb.transactional(xg=True)
+def resizeSeats(conf, delta):
+    """Add delta seats to conf, or take -delta free seats away, and adjust
+    conf.seatsAvailable to match; the caller puts conf. Return False if
+    there are too few free seats, after which the transaction must be
+    rolled back.
+    """
+    seats = (conf.seatsAvailable or 0) + delta
+    if not conf.seatShards:
+        if seats < 0:
+            return False
+        shards = makeSeatShards(conf.key, seats)
+        conf.seatShards = len(shards)
+        ndb.put_multi(shards)
+    elif delta > 0:
+        releaseSeats(conf, delta)
+    elif delta < 0 and reserveSeats(conf, -delta) < -delta:
+        return False
+    conf.seatsAvailable = max(0, seats)
+    return True
+
+
+def scheduleSeatReconcile(c_key):
+    """Enqueue one reconcile task per conference per RECONCILE_DELAY."""
+    wsck = c_key.urlsafe()
+    if memcache.add(MEMCACHE_RECONCILE_KEY % wsck, 1, time=RECONCILE_DELAY):
+        taskqueue.add(params={'websafeConferenceKey': wsck},
+            url='/tasks/reconcile_seats',
+            countdown=RECONCILE_DELAY
+        )
+
+
+def reconcileSeats(c_key):
+    """Write the sum of a conference's shards to Conference.seatsAvailable."""
+    # clear the flag first so changes made from here on get a new task
+    memcache.delete(MEMCACHE_RECONCILE_KEY % c_key.urlsafe())
+    conf = c_key.get()
+    if not conf or not conf.seatShards:
+        return
+    shards = ndb.get_multi(
+        [_shardKey(c_key, i) for i in range(conf.seatShards)])
+    total = sum(shard.seatsAvailable for shard in shards if shard)
+    _setSeatsAvailable(c_key, total)
+
+
+@ndb.transactional()
+def _setSeatsAvailable(c_key, total):
+    """Store the reconciled total on the Conference."""
+    conf = c_key.get()
+    if conf.seatsAvailable != total:
+        seats_before = conf.seatsAvailable
+        conf.seatsAvailable = total
+        conf.put()
+        invalidateEntities(c_key)
+        invalidateQueryResults()
+        conferenceSeatsChanged(conf, seats_before)
@@ -346,6 +346,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.pagination = $scope.pagination || {};
     $scope.pagination.currentPage = 0;
     $scope.pagination.pageSize = 20;
+
+    /**
+     * Holds the cursor returned by queryConferences for fetching the next page, if any.
+     * @type {string|null}
+     */
+    $scope.pagination.nextCursor = null;
+
     /**
      * Returns the number of the pages in the pagination.
      *
@@ -379,6 +386,15 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         return angular.element(event.target).hasClass('disabled');
     }
 
+    /**
+     * Fetches the next page of conferences from the server and appends it to $scope.conferences.
+     */
+    $scope.pagination.loadMore = function () {
+        if ($scope.pagination.nextCursor) {
+            $scope.queryConferencesAll(true);
+        }
+    };
+
     /**
      * Adds a filter and set the default value.
      */
@@ -425,10 +441,16 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Invokes the conference.queryConferences API.
+     *
+     * @param loadMore if true, continues from the last returned cursor instead of starting over.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (loadMore) {
         var sendFilters = {
-            filters: []
+            filters: [],
+            pageSize: $scope.pagination.pageSize
+        }
+        if (loadMore && $scope.pagination.nextCursor) {
+            sendFilters.websafeCursor = $scope.pagination.nextCursor;
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -458,10 +480,17 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!loadMore) {
+                            $scope.conferences = [];
+                            $scope.pagination.currentPage = 0;
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.pagination.nextCursor = resp.nextPageCursor || null;
+                        if (loadMore) {
+                            $scope.pagination.currentPage = $scope.pagination.numberOfPages() - 1;
+                        }
                     }
                     $scope.submitted = true;
                 });
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+test_profiles.py -- Udacity conference server-side Python App Engine
+    datastore write counts for lazily created profiles
+
+Run with the App Engine SDK on sys.path:
+    python -m unittest test_profiles
+
+"""
+
+import os
+import unittest
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from cache import getCachedEntity
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import ProfileMiniForm
+from models import TeeShirtSize
+
+DISPLAY_NAME_TASK_URL = '/tasks/update_organizer_display_name'
+
+
+class ProfileWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(__file__))
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+        self.user = users.User('organizer@example.com')
+        self.p_key = ndb.Key(Profile, self.user.email())
+        self._get_current_user = endpoints.get_current_user
+        endpoints.get_current_user = lambda: self.user
+
+        self.puts = 0
+        def countPuts(service, call, request, response):
+            if call == 'Put':
+                self.puts += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count_puts', countPuts, 'datastore_v3')
+        self.api = ConferenceApi()
+
+    def tearDown(self):
+        endpoints.get_current_user = self._get_current_user
+        self.testbed.deactivate()
+
+    def displayNameTasks(self):
+        return self.taskqueue.get_filtered_tasks(url=DISPLAY_NAME_TASK_URL)
+
+    def testGetProfileDoesNotWrite(self):
+        self.api._doProfile()
+        self.api._doProfile()
+        self.assertEqual(self.puts, 0)
+        self.assertIsNone(self.p_key.get())
+        # nothing stored, so nothing for the entity cache to hold either
+        self.assertIsNone(getCachedEntity(self.p_key))
+
+    def testSaveProfileWritesOnce(self):
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer',
+                                            teeShirtSize=TeeShirtSize.M_M))
+        self.assertEqual(self.puts, 1)
+        prof = self.p_key.get()
+        self.assertEqual(prof.displayName, 'Organizer')
+        self.assertEqual(prof.teeShirtSize, 'M_M')
+        self.assertEqual(len(self.displayNameTasks()), 1)
+
+    def testUnchangedSaveProfileDoesNotWrite(self):
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer'))
+        self.puts = 0
+        self.taskqueue.FlushQueue('default')
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer'))
+        self.assertEqual(self.puts, 0)
+        self.assertEqual(self.displayNameTasks(), [])
+
+    def testSaveProfileInvalidatesEntityCache(self):
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer'))
+        self.assertEqual(getCachedEntity(self.p_key).displayName, 'Organizer')
+        self.api._doProfile(ProfileMiniForm(displayName='Renamed'))
+        ndb.get_context().clear_cache()
+        self.assertEqual(getCachedEntity(self.p_key).displayName, 'Renamed')
+        self.assertEqual(self.api._doProfile().displayName, 'Renamed')
+
+    def testDisplayNameFanOutWritesOneBatch(self):
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer'))
+        ndb.put_multi([Conference(parent=self.p_key, name='Conf %d' % i,
+                                  organizerUserId=self.p_key.id(),
+                                  organizerDisplayName='Old')
+                       for i in range(3)])
+        self.puts = 0
+        ConferenceApi._updateOrganizerDisplayName(self.p_key.id())
+        self.assertEqual(self.puts, 1)
+        self.assertEqual(
+            set(c.organizerDisplayName for c in Conference.query(ancestor=self.p_key)),
+            set(['Organizer']))
+        # a second run has nothing left to copy
+        self.puts = 0
+        ConferenceApi._updateOrganizerDisplayName(self.p_key.id())
+        self.assertEqual(self.puts, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+benchmark_form_copy.py -- Udacity conference server-side Python App Engine
+    timing of the reflective entity to form copy against formFieldCopier
+
+Run with the App Engine SDK on sys.path:
+    python benchmark_form_copy.py
+
+"""
+
+import timeit
+from datetime import date
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+
+ENTITIES = 1000
+REPEAT = 5
+
+
+def reflectiveCopy(conf, displayName):
+    """Copy Conference to ConferenceForm the way the app did before
+    formFieldCopier: reflect over all_fields for every entity."""
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            # convert Date to date string; just copy others
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def main():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        confs = [Conference(key=ndb.Key(Conference, i + 1), name='Conf %d' % i,
+                            description='A conference', city='London',
+                            topics=['Python', 'Web'], startDate=date(2015, 6, 1),
+                            endDate=date(2015, 6, 3), month=6,
+                            maxAttendees=100, seatsAvailable=40,
+                            organizerUserId='organizer@example.com')
+                 for i in range(ENTITIES)]
+        api = ConferenceApi()
+        # both copies must give the same forms before timing them
+        assert [reflectiveCopy(c, 'Organizer') for c in confs] == \
+            [api._copyConferenceToForm(c, 'Organizer') for c in confs]
+
+        old = min(timeit.repeat(
+            lambda: [reflectiveCopy(c, 'Organizer') for c in confs],
+            number=1, repeat=REPEAT))
+        new = min(timeit.repeat(
+            lambda: [api._copyConferenceToForm(c, 'Organizer') for c in confs],
+            number=1, repeat=REPEAT))
+        print '%d Conferences to ConferenceForm, best of %d:' % (ENTITIES, REPEAT)
+        print '  all_fields reflection: %7.2f ms' % (old * 1000)
+        print '  formFieldCopier:       %7.2f ms  (%.1fx)' % (new * 1000, old / new)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
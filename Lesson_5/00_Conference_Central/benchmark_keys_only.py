@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+benchmark_keys_only.py -- Udacity conference server-side Python App Engine
+    datastore ops & latency of keys-only against full-entity queries
+
+Runs queryConferences & getConferenceSessions with KEYS_ONLY_QUERIES on
+and off, once against a cold memcache and then repeatedly against a
+warm one, counting RPCs and billed datastore ops through apiproxy hooks.
+
+Run with the App Engine SDK on sys.path:
+    python benchmark_keys_only.py
+
+"""
+
+import time
+from datetime import date
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import conference
+from conference import ConferenceApi
+from conference import SESS_LIST_REQUEST
+from models import Conference
+from models import ConferenceQueryForms
+from models import Profile
+from models import Session
+
+CONFERENCES = 200
+SESSIONS = 200
+WARM_RUNS = 20
+
+
+class OpCounter(object):
+    """Count datastore RPCs & the read / small ops they are billed."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.rpcs = {}
+        self.reads = 0
+        self.smallOps = 0
+
+    def count(self, service, call, request, response):
+        self.rpcs[call] = self.rpcs.get(call, 0) + 1
+        if call in ('RunQuery', 'Next'):
+            if call == 'RunQuery':
+                self.reads += 1         # one read per query run
+            if response.keys_only():
+                self.smallOps += response.result_size()
+            else:
+                self.reads += response.result_size()
+        elif call == 'Get':
+            self.reads += sum(1 for i in range(response.entity_size())
+                              if response.entity(i).has_entity())
+
+
+def _setUp():
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+
+    organizer = Profile(key=ndb.Key(Profile, 'organizer@example.com'),
+                        displayName='Organizer')
+    confs = [Conference(parent=organizer.key, name='Conf %04d' % i,
+                        city='London', startDate=date(2015, 6, 1), month=6,
+                        maxAttendees=100, seatsAvailable=100,
+                        organizerUserId=organizer.key.id())
+             for i in range(CONFERENCES)]
+    ndb.put_multi([organizer] + confs)
+    ndb.put_multi([Session(parent=confs[0].key, name='Talk %d' % i,
+                           confWebSafeKey=confs[0].key.urlsafe())
+                   for i in range(SESSIONS)])
+    return bed, confs[0].key.urlsafe()
+
+
+def _measure(counter, handler, runs):
+    """Return (ms per run, counts per run) of handler as fresh requests."""
+    counter.reset()
+    elapsed = 0.0
+    for _ in range(runs):
+        # every request starts with an empty ndb context cache
+        ndb.get_context().clear_cache()
+        start = time.time()
+        handler()
+        elapsed += time.time() - start
+    rpcs = ', '.join('%s %.1f' % (call, count / float(runs))
+                     for call, count in sorted(counter.rpcs.items()))
+    return (elapsed * 1000 / runs, counter.reads / float(runs),
+            counter.smallOps / float(runs), rpcs)
+
+
+def main():
+    bed, wsck = _setUp()
+    try:
+        counter = OpCounter()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'count_ops', counter.count, 'datastore_v3')
+        api = ConferenceApi()
+        handlers = [
+            ('queryConferences (%d)' % CONFERENCES,
+             lambda: api.queryConferences(ConferenceQueryForms())),
+            ('getConferenceSessions (%d)' % SESSIONS,
+             lambda: api.getConferenceSessions(
+                SESS_LIST_REQUEST.combined_message_class(
+                    websafeConferenceKey=wsck))),
+        ]
+        for name, handler in handlers:
+            print name
+            for keys_only in (False, True):
+                conference.KEYS_ONLY_QUERIES = keys_only
+                memcache.flush_all()
+                for label, runs in (('cold', 1), ('warm', WARM_RUNS)):
+                    ms, reads, small, rpcs = _measure(counter, handler, runs)
+                    print '  %-11s %s: %8.2f ms  %6.1f reads  %6.1f small ops  [%s]' % (
+                        'keys-only' if keys_only else 'full', label,
+                        ms, reads, small, rpcs)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+benchmark_session_rpcs.py -- Udacity conference server-side Python App Engine
+    latency of createSession & updateSession with & without overlapped RPCs
+
+The testbed stubs answer RPCs one at a time and at once, so overlapping
+them can't show in wall time here. Instead every RPC is charged a fixed
+RPC_LATENCY from the moment it is issued, and the clock only moves when
+a result is waited for: RPCs in flight together cost one latency, RPCs
+issued one after another cost one each.
+
+"Synchronous" runs the same handlers with every get_async, put_async,
+allocate_ids_async & fetch_async made by conference.py waited for as
+soon as it is issued, which is how the handlers ran before they were
+rewritten with futures; batched gets inside ndb are left alone.
+
+Run with the App Engine SDK on sys.path:
+    python benchmark_session_rpcs.py
+
+"""
+
+import sys
+import time
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import ConferenceApi
+from conference import SESS_POST_REQUEST
+from conference import SESS_UPDATE_REQUEST
+from models import Conference
+from models import Profile
+
+RPC_LATENCY = 20.0              # ms charged per RPC
+RUNS = 50
+
+
+class RpcClock(object):
+    """Simulated wall clock charging RPC_LATENCY per RPC from its issue."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._issued = {}
+
+    def issue(self, service, call, request, response):
+        self._issued[id(request)] = self.now
+
+    def complete(self, service, call, request, response):
+        issued = self._issued.pop(id(request), self.now)
+        self.now = max(self.now, issued + RPC_LATENCY)
+
+
+def _waitedAtOnce(method):
+    """Wrap an *_async method so calls made from conference.py are waited
+    for immediately, as the synchronous API did."""
+    def wrapper(*args, **kwds):
+        future = method(*args, **kwds)
+        if sys._getframe(1).f_globals.get('__name__') == 'conference':
+            future.wait()
+        return future
+    return wrapper
+
+
+class Synchronous(object):
+    """Context manager running conference.py's async RPCs synchronously
+    while enabled."""
+
+    PATCHES = (
+        (ndb.Key, 'get_async'),
+        (ndb.Model, 'put_async'),
+        (ndb.Query, 'fetch_async'),
+    )
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if not self.enabled:
+            return
+        self._saved = [(cls, name, cls.__dict__[name]) for cls, name in self.PATCHES]
+        for cls, name, method in self._saved:
+            setattr(cls, name, _waitedAtOnce(method))
+        self._allocate = ndb.Model.__dict__['allocate_ids_async']
+        ndb.Model.allocate_ids_async = classmethod(
+            _waitedAtOnce(self._allocate.__func__))
+
+    def __exit__(self, *exc_info):
+        if not self.enabled:
+            return
+        for cls, name, method in self._saved:
+            setattr(cls, name, method)
+        ndb.Model.allocate_ids_async = self._allocate
+
+
+def _run(clock, api, handler, requests):
+    """Return ((simulated ms, wall ms) per request, responses) of handler."""
+    responses = []
+    start_clock, start_wall = clock.now, time.time()
+    for request in requests:
+        ndb.get_context().clear_cache()
+        responses.append(handler(api, request))
+    runs = float(len(requests))
+    return (((clock.now - start_clock) / runs,
+             (time.time() - start_wall) * 1000 / runs), responses)
+
+
+def main():
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+
+    user = users.User('organizer@example.com')
+    get_current_user = endpoints.get_current_user
+    endpoints.get_current_user = lambda: user
+    try:
+        organizer = Profile(key=ndb.Key(Profile, user.email()),
+                            displayName='Organizer')
+        speaker = Profile(key=ndb.Key(Profile, 'speaker@example.com'),
+                          displayName='Speaker')
+        conf = Conference(parent=organizer.key, name='PyCon',
+                          organizerUserId=user.email())
+        ndb.put_multi([organizer, speaker, conf])
+        wsck = conf.key.urlsafe()
+
+        clock = RpcClock()
+        hooks = apiproxy_stub_map.apiproxy
+        hooks.GetPreCallHooks().Append('rpc_issue', clock.issue)
+        hooks.GetPostCallHooks().Append('rpc_complete', clock.complete)
+        api = ConferenceApi()
+
+        def create(api, i):
+            return api._createSessionObject(SESS_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=wsck, name='Talk %d' % i,
+                speakerUserId=speaker.key.id(), startTime='10:00:00'))
+
+        def update(api, websafeKey):
+            return api._updateSession(SESS_UPDATE_REQUEST.combined_message_class(
+                websafeSessionKey=websafeKey, duration=2,
+                speakerUserId=speaker.key.id()))
+
+        print 'per request, %d runs, %.0f ms per RPC:' % (RUNS, RPC_LATENCY)
+        for label, synchronous in (('synchronous', True), ('futures', False)):
+            with Synchronous(synchronous):
+                created, sessions = _run(clock, api, create, range(RUNS))
+                updated, _ = _run(clock, api, update,
+                                  [s.websafeKey for s in sessions])
+            for name, (simulated, wall) in (('createSession', created),
+                                            ('updateSession', updated)):
+                print '  %-13s %-11s %7.1f ms simulated  %6.2f ms stub wall time' % (
+                    name, label, simulated, wall)
+    finally:
+        endpoints.get_current_user = get_current_user
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+cache.py -- Udacity conference server-side Python App Engine
+    stampede-safe memcache values for announcements & featured speakers
+
+getFresh() caches computed values. Only the request holding a short
+memcache lease recomputes an expired value; the others keep serving the
+stale copy meanwhile, and TTLs are jittered so values cached together
+don't expire together.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+
+STALE_TTL = 5 * 60              # seconds a stale value is served past its TTL
+LEASE_TTL = 10                  # seconds one request may spend recomputing
+LEASE_WAIT = 0.05               # seconds between checks for another's result
+LEASE_WAIT_POLLS = 4
+TTL_JITTER = 0.1                # TTLs vary by +-10%
+CAS_RETRIES = 5
+
+
+def _leaseKey(key):
+    """Return memcache key of the recompute lease for key."""
+    return 'LEASE:' + key
+
+
+def setFresh(key, value, ttl):
+    """Cache value under key for about ttl seconds, then serve it stale
+    for STALE_TTL more while it is recomputed."""
+    ttl *= random.uniform(1 - TTL_JITTER, 1 + TTL_JITTER)
+    memcache.set(key, (value, time.time() + ttl), time=int(ttl + STALE_TTL))
+
+
+def getFresh(key, recompute, ttl, default=None):
+    """Return the value cached under key; if it is missing or stale, one
+    request recomputes & caches it while the others use the stale copy,
+    or default if there is none yet."""
+    entry = memcache.get(key)
+    # values cached without setFresh() count as missing
+    if not isinstance(entry, tuple):
+        entry = None
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() < fresh_until or \
+                not memcache.add(_leaseKey(key), 1, time=LEASE_TTL):
+            return value
+    elif not memcache.add(_leaseKey(key), 1, time=LEASE_TTL):
+        # another request is recomputing; give it a moment to finish,
+        # but never pile onto the cold datastore query ourselves
+        for _ in range(LEASE_WAIT_POLLS):
+            time.sleep(LEASE_WAIT)
+            entry = memcache.get(key)
+            if isinstance(entry, tuple):
+                return entry[0]
+        return default
+
+    try:
+        value = recompute()
+        setFresh(key, value, ttl)
+    finally:
+        memcache.delete(_leaseKey(key))
+    return value
+
+
+def updateFresh(key, update):
+    """Replace the value cached under key with update(value), keeping its
+    expiry; return False if it isn't cached or kept changing under us."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(key)
+        if not isinstance(entry, tuple):
+            return False
+        value, fresh_until = entry
+        remaining = int(fresh_until - time.time() + STALE_TTL)
+        if remaining < 1:
+            return False
+        if client.cas(key, (update(value), fresh_until), time=remaining):
+            return True
+    return False
@@ -13,6 +13,7 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import logging
 from datetime import datetime
 
 import endpoints
@@ -20,10 +21,8 @@ from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
 
 from models import ConflictException
 from models import Profile
@@ -41,7 +40,20 @@ from models import Session, SessionPostForm, SessionForm, SessionForms
 from models import SessionQueryByTypeByStartTimeForm
 from models import FeatureSpeakerForm, FeatureSpeakerForms
 
-from utils import getUserId
+from utils import copyToFormValues
+from utils import formFieldCopier
+
+from context import currentUser
+from context import requestContext
+
+from search import DEFAULT_SEARCH_LIMIT
+from search import MAX_SEARCH_LIMIT
+from search import documentTerms
+from search import search
+from search import updateIndex
+
+from cache import getFresh
+from cache import setFresh
 
 from settings import WEB_CLIENT_ID
 
@@ -49,9 +61,30 @@ EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATURE_SPEAKERS_KEY = "FEATURE_SPEAKERS"
+ANNOUNCEMENT_TTL = 2 * 60 * 60      # seconds; the hourly cron refreshes it first
+FEATURED_SPEAKER_TTL = 60 * 60      # seconds; rebuilt by the same rule once stale
+
+# run list queries keys-only & resolve entities with get_multi, so repeat
+# listings are served from ndb's context cache & memcache
+KEYS_ONLY_QUERIES = True
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+# entity -> form field lists & conversions, worked out once at import
+CONFERENCE_FORM_FIELDS = formFieldCopier(ConferenceForm, Conference,
+    {'startDate': str, 'endDate': str})
+PROFILE_FORM_FIELDS = formFieldCopier(ProfileForm, Profile,
+    {'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
+SESSION_FORM_FIELDS = formFieldCopier(SessionForm, Session,
+    {'date': str, 'startTime': str})
+# summary mode: listing fields only, loaded with a projection query
+SESSION_SUMMARY_FIELDS = ('name', 'date', 'startTime')
+SESSION_SUMMARY_FORM_FIELDS = formFieldCopier(SessionForm, Session,
+    {'date': str, 'startTime': str}, names=SESSION_SUMMARY_FIELDS)
+
+# search term weight per Session field
+SESSION_SEARCH_BOOSTS = (('name', 3), ('highlights', 1))
+
 DEFAULTS = {
     "city": "Default City",
     "maxAttendees": 0,
@@ -98,6 +131,12 @@ SESS_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESS_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    summary=messages.BooleanField(2),
+)
+
 SESS_GET_BY_TYPE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -124,9 +163,27 @@ SESS_GET_BY_KEY_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1, required=True),
 )
 
+SESS_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
+@ndb.tasklet
+def _fetchEntitiesAsync(query):
+    """Fetch all results of query, keys-only + get_multi if KEYS_ONLY_QUERIES."""
+    if not KEYS_ONLY_QUERIES:
+        entities = yield query.fetch_async()
+        raise ndb.Return(entities)
+    keys = yield query.fetch_async(keys_only=True)
+    entities = yield ndb.get_multi_async(keys)
+    # skip entities deleted since the index was read
+    raise ndb.Return([e for e in entities if e is not None])
+
+
 @endpoints.api(name='conference', version='v1',
     allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID],
     scopes=[EMAIL_SCOPE])
@@ -137,29 +194,17 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        values = copyToFormValues(conf, CONFERENCE_FORM_FIELDS)
+        values['websafeKey'] = conf.key.urlsafe()
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+            values['organizerDisplayName'] = displayName
+        return ConferenceForm(**values)
 
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -190,14 +235,19 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
+        prof_future = p_key.get_async()
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # creation of Conference & return (modified) ConferenceForm;
+        # profiles are created lazily, but an organizer needs one stored
+        entities = [Conference(**data)]
+        if prof_future.get_result() is None:
+            entities.append(self._getProfileFromUser())
+        ndb.put_multi(entities)
         # TODO 2: add confirmation email sending task to queue
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
@@ -209,10 +259,7 @@ class ConferenceApi(remote.Service):
 
     @ndb.transactional()
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -247,7 +294,7 @@ class ConferenceApi(remote.Service):
 
 
 
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName', None))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -277,7 +324,7 @@ class ConferenceApi(remote.Service):
                 'No conference found with key: %s' % request.websafeConferenceKey)
         prof = conf.key.parent().get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName', None))
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -286,16 +333,13 @@ class ConferenceApi(remote.Service):
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id =  getUserId(user)
+        user, user_id = currentUser()
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
         prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName', None)) for conf in confs]
         )
 
 
@@ -353,7 +397,9 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        # run the query once; the results feed both the organiser
+        # lookup and the forms below
+        conferences = _fetchEntitiesAsync(self._getQuery(request)).get_result()
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -363,11 +409,13 @@ class ConferenceApi(remote.Service):
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            # organizers of older conferences may have no Profile
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
+                items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId)) for conf in \
                 conferences]
         )
 
@@ -376,28 +424,22 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return ProfileForm(**copyToFormValues(prof, PROFILE_FORM_FIELDS))
 
 
     def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
+        """Return user Profile from datastore, or a new unsaved one if
+        non-existent; it is only written once something changes it."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user, user_id = currentUser()
+        context = requestContext()
+        # a transaction (or its retry) must read the Profile afresh; an
+        # earlier attempt may have changed the request's copy
+        in_transaction = ndb.in_transaction()
+        if context.profile and not in_transaction:
+            return context.profile
 
         # get Profile from datastore
-        user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
         # create new Profile if not there
@@ -408,8 +450,9 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
 
+        if not in_transaction:
+            context.profile = profile
         return profile      # return Profile
 
 
@@ -420,16 +463,20 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            changed = False
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
-                    if val:
+                    if val and getattr(prof, field) != str(val):
                         setattr(prof, field, str(val))
+                        changed = True
                         #if field == 'teeShirtSize':
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-            prof.put()
+            # one write for all fields, none if nothing changed
+            if changed:
+                prof.put()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -516,10 +563,12 @@ class ConferenceApi(remote.Service):
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            # organizers of older conferences may have no Profile
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))\
          for conf in conferences]
         )
 
@@ -544,29 +593,28 @@ class ConferenceApi(remote.Service):
 
 # TODO 1
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
+    def _announcementText():
+        """Return Announcement for nearly sold out conferences, or ''."""
         confs = Conference.query(ndb.AND(
             Conference.seatsAvailable <= 5,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
 
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if not confs:
+            return ''
+        return '%s %s' % (
+            'Last chance to attend! The following conferences '
+            'are nearly sold out:',
+            ', '.join(conf.name for conf in confs))
 
+
+    @staticmethod
+    def _cacheAnnouncement():
+        """Create Announcement & assign to memcache; used by
+        memcache cron job & putAnnouncement().
+        """
+        announcement = ConferenceApi._announcementText()
+        setFresh(MEMCACHE_ANNOUNCEMENTS_KEY, announcement, ANNOUNCEMENT_TTL)
         return announcement
 
 
@@ -575,11 +623,9 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        # TODO 1
-        # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ''
+        # recomputed by one request at a time if memcache has lost it
+        announcement = getFresh(MEMCACHE_ANNOUNCEMENTS_KEY,
+            self._announcementText, ANNOUNCEMENT_TTL, default='')
         return StringMessage(data=announcement)
 
 
@@ -587,19 +633,23 @@ class ConferenceApi(remote.Service):
 
     def _copySessionToForm(self, session, confName):
         """Copy relevant fields from Session to SessionForm"""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(session, field.name):
-                if field.name in ['date', 'startTime']:
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(session, field.name))
-            elif field.name == 'websafeKey':
-                setattr(sf, field.name, session.key.urlsafe())
+        values = copyToFormValues(session, SESSION_FORM_FIELDS)
+        values['websafeKey'] = session.key.urlsafe()
         if confName:
-            setattr(sf, 'conferenceDisplayName', confName)
-        sf.check_initialized()
-        return sf
+            values['conferenceDisplayName'] = confName
+        return SessionForm(**values)
+
+    def _copySessionSummaryToForm(self, session):
+        """Copy listing fields from (projected) Session to SessionForm"""
+        values = copyToFormValues(session, SESSION_SUMMARY_FORM_FIELDS)
+        values['websafeKey'] = session.key.urlsafe()
+        return SessionForm(**values)
+
+    @staticmethod
+    def _sessionSearchTerms(session):
+        """Return {term: weight} indexed for session"""
+        return documentTerms([(getattr(session, field), boost)
+            for field, boost in SESSION_SEARCH_BOOSTS])
 
     def _createSpeaker(self, request):
         """creat speaker profile if it does not exist,
@@ -623,10 +673,7 @@ class ConferenceApi(remote.Service):
     def _createSessionObject(self, request):
         """create new session entity, requst is SESS_POST_REQUEST type"""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         # report error if no session name is given
         if not request.name:
@@ -647,8 +694,17 @@ class ConferenceApi(remote.Service):
 
         # print data
 
+        # start the parent conference get, speaker get & session id
+        # allocation together; none of them depends on another
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf_future = c_key.get_async()
+        speaker_future = None
+        if data['speakerUserId']:
+            speaker_future = ndb.Key(Profile, data['speakerUserId']).get_async()
+        ids_future = Session.allocate_ids_async(size=1, parent=c_key)
+
         # get parent conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = conf_future.get_result()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
@@ -659,8 +715,8 @@ class ConferenceApi(remote.Service):
                 'Only the conference owner can create session.')
 
         # check if speaker specified
-        if data['speakerUserId']:
-            speaker = ndb.Key(Profile, data['speakerUserId']).get()
+        if speaker_future:
+            speaker = speaker_future.get_result()
             # if such speaker has been created in Profile Kind
             if speaker:
                 # set or override with the name in the Profile
@@ -678,14 +734,14 @@ class ConferenceApi(remote.Service):
         if data['startTime']:
             data['startTime'] = datetime.strptime(data['startTime'][:8], "%H:%M:%S").time()
 
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        session_id = Session.allocate_ids(size=1, parent=c_key)[0]
+        session_id = ids_future.get_result()[0]
         session_key = ndb.Key(Session, session_id, parent=c_key)
         data['key'] = session_key
         data['confWebSafeKey'] = request.websafeConferenceKey
         data['creatorUserId'] = user_id
         s = Session(**data)
         s.put()
+        updateIndex('Session', [(session_key, None, self._sessionSearchTerms(s))])
 
         # check if feature speaker, add to taskqueue
         if s.speakerUserId:
@@ -723,7 +779,31 @@ class ConferenceApi(remote.Service):
 
         for s in sessions:
             fsf.sessionList.append(s.name)
-        memcache.set('FSP_' + websafeConferenceKey, fsf)
+        setFresh('FSP_' + websafeConferenceKey, fsf, FEATURED_SPEAKER_TTL)
+
+
+    @staticmethod
+    def _featuredSpeaker(websafeConferenceKey):
+        """Return FeatureSpeakerForm for the speaker of the latest session
+        whose speaker has more than one, the same rule _cacheFeatureSpeaker
+        applies per new session; rebuilds the memcache entry once stale"""
+        c_key = ndb.Key(urlsafe=websafeConferenceKey)
+        by_speaker = {}
+        latest = []
+        for s in Session.query(ancestor=c_key).fetch():
+            if s.speakerUserId:
+                by_speaker.setdefault(s.speakerUserId, []).append(s)
+                latest.append(s)
+        # sessions created before Session.created count as oldest
+        latest.sort(key=lambda s: (s.created or datetime.min, s.key.id()),
+                    reverse=True)
+        for s in latest:
+            sessions = by_speaker[s.speakerUserId]
+            if len(sessions) > 1:
+                return FeatureSpeakerForm(speakerUserId=s.speakerUserId,
+                    speakerName=s.speakerName,
+                    sessionList=[session.name for session in sessions])
+        return FeatureSpeakerForm() # no feature speaker
 
 
     @endpoints.method(SESS_POST_REQUEST, SessionForm,
@@ -733,7 +813,7 @@ class ConferenceApi(remote.Service):
         """Create new session"""
         return self._createSessionObject(request)
 
-    @endpoints.method(SESS_GET_REQUEST, SessionForms,
+    @endpoints.method(SESS_LIST_REQUEST, SessionForms,
         path='session/{websafeConferenceKey}',
         http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
@@ -742,13 +822,39 @@ class ConferenceApi(remote.Service):
             conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
         except:
             raise endpoints.NotFoundException("Invalid key %s" % request.websafeConferenceKey)
+        # run the conference get & the session query concurrently
+        if request.summary:
+            sessions_future = Session.query(ancestor=conf_key).fetch_async(
+                projection=SESSION_SUMMARY_FIELDS)
+        else:
+            sessions_future = _fetchEntitiesAsync(Session.query(ancestor=conf_key))
         conf = conf_key.get()
         if not conf:
             raise endpoints.NotFoundException("No conference found with key %s" % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf_key)
+        sessions = sessions_future.get_result()
+        if request.summary:
+            return SessionForms(items=[self._copySessionSummaryToForm(s) for s in sessions])
         return SessionForms(items=[self._copySessionToForm(s, getattr(conf, 'name')) for s in sessions])
 
 
+    @endpoints.method(SESS_SEARCH_REQUEST, SessionForms,
+        path='sessions/search',
+        http_method='GET', name='searchSessions')
+    def searchSessions(self, request):
+        """Get sessions best matching keywords in name & highlights"""
+        limit = request.limit or DEFAULT_SEARCH_LIMIT
+        if limit < 1 or limit > MAX_SEARCH_LIMIT:
+            raise endpoints.BadRequestException(
+                "limit must be between 1 and %d." % MAX_SEARCH_LIMIT)
+        keys = search('Session', request.q, limit)
+        # skip sessions deleted since they were indexed
+        sessions = [s for s in ndb.get_multi(keys) if s]
+        confs = ndb.get_multi(set(ndb.Key(urlsafe=s.confWebSafeKey) for s in sessions))
+        names = dict((conf.key.urlsafe(), conf.name) for conf in confs if conf)
+        return SessionForms(items=[self._copySessionToForm(s, names.get(s.confWebSafeKey))
+            for s in sessions])
+
+
     @endpoints.method(SESS_GET_BY_TYPE_REQUEST, SessionForms,
         path='session/{websafeConferenceKey}/{typeOfSession}',
         http_method='GET', name='getConferenceSessionsByType')
@@ -759,11 +865,13 @@ class ConferenceApi(remote.Service):
             conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
         except:
             raise endpoints.NotFoundException("Invalid key %s" % request.websafeConferenceKey)
+        # run the conference get & the session query concurrently
+        sessions_future = _fetchEntitiesAsync(Session.query(ancestor=conf_key).filter(
+            Session.typeOfSession == query_session_type))
         conf = conf_key.get()
         if not conf:
             raise endpoints.NotFoundException("No conference found with key %s" % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf_key)
-        sessions = sessions.filter(Session.typeOfSession == query_session_type)
+        sessions = sessions_future.get_result()
         return SessionForms(items=[self._copySessionToForm(s, getattr(conf, 'name')) for s in sessions])
 
 
@@ -773,12 +881,14 @@ class ConferenceApi(remote.Service):
     def getSessionsBySpeaker(self, request):
         """Get all sessions given by a particular speaker, across all conferences"""
         speakerUserId=request.speakerUserId
+        # run the speaker get & the session query concurrently
+        sessions_future = _fetchEntitiesAsync(
+            Session.query(Session.speakerUserId==speakerUserId))
         speaker = ndb.Key(Profile, speakerUserId).get()
         if not speaker:
             raise endpoints.NotFoundException("No speaker profile found with key %s" % speakerUserId)
 
-        sessions = Session.query(Session.speakerUserId==speakerUserId)
-        items = []
+        sessions = sessions_future.get_result()
         conf_keys = [ndb.Key(urlsafe=s.confWebSafeKey) for s in sessions]
         confs = ndb.get_multi(conf_keys)
         items = []
@@ -857,10 +967,7 @@ class ConferenceApi(remote.Service):
 
     def _deleteSession(self, request):
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         session = ndb.Key(urlsafe=request.websafeSessionKey).get()
         if not session:
@@ -871,19 +978,20 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 "Only the onwer can delete this session!")
         session.key.delete()
+        updateIndex('Session', [(session.key, self._sessionSearchTerms(session), None)])
         return BooleanMessage(data=True)
 
     def _updateSession(self, request):
         """update session. request is SESS_UPDATE_REQUEST type"""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = currentUser()
 
         if request.speakerName and not request.speakerUserId:
             raise endpoints.ForbiddenException('Bad request: speakerName cannot come without speakerUserId')
 
+        # fetch the session & speaker profile together
+        if request.speakerUserId:
+            speaker_future = ndb.Key(Profile, request.speakerUserId).get_async()
         try:
             session = ndb.Key(urlsafe=request.websafeSessionKey).get()
         except:
@@ -895,6 +1003,7 @@ class ConferenceApi(remote.Service):
         if user_id != session.creatorUserId:
             raise endpoints.ForbiddenException(
                 "Only the owner can update this session!")
+        terms_before = self._sessionSearchTerms(session)
 
         # print request
         for field in request.all_fields():
@@ -907,15 +1016,19 @@ class ConferenceApi(remote.Service):
                 setattr(session, field.name, data)
 
         # check if request has speakerUserId, if speaker has not been created, create a new one.
-        if hasattr(request, 'speakerUserId'):
-            speaker = ndb.Key(Profile, request.speakerUserId).get()
+        if request.speakerUserId:
+            speaker = speaker_future.get_result()
             if not speaker:
                 speaker = self._createSpeaker(request)
             # set session speakerName with the one in database
             setattr(session, 'speakerName', speaker.displayName)
 
-        session.put()
+        # write the session while its conference is fetched
+        put_future = session.put_async()
         conf = ndb.Key(urlsafe=session.confWebSafeKey).get()
+        put_future.check_success()
+        updateIndex('Session',
+            [(session.key, terms_before, self._sessionSearchTerms(session))])
         return self._copySessionToForm(session, conf.name)
 
 
@@ -939,33 +1052,62 @@ class ConferenceApi(remote.Service):
         request is SessionQueryByTypeByStartTimeForm type"""
         # request only has disallowed types. Session type is a Enum value.
         # by excluding the disallowed types from list, get preferred session types.
-        allowed_session_types = []
-        for t in SessionTypes:
-            if not t in request.typeOfSessionDisallowed:
-                allowed_session_types.append(t)
-        # print t
+        disallowed_session_types = set(request.typeOfSessionDisallowed)
+        allowed_session_types = [t for t in SessionTypes
+            if t not in disallowed_session_types]
+        if not allowed_session_types:
+            return SessionForms(items=[], queryPlan='no session type allowed')
+
+        # start and end time restrict the startTime index range
+        q = Session.query()
         if request.earliestStartTime:
             earliestStartTime = datetime.strptime(request.earliestStartTime, "%H:%M:%S").time()
-        if request.latestStartTime:
-            latestStartTime = datetime.strptime(request.latestStartTime, "%H:%M:%S").time()
-
-        # first level of query to get all the sessions in allowed session types.
-        q = Session.query(Session.typeOfSession.IN(allowed_session_types))
-        # second and third level of queries for startTime and endTime
-        if request.earliestStartTime:
             q = q.filter(Session.startTime >= earliestStartTime)
         if request.latestStartTime:
+            latestStartTime = datetime.strptime(request.latestStartTime, "%H:%M:%S").time()
             q = q.filter(Session.startTime <= latestStartTime)
-        conf_keys = [(ndb.Key(urlsafe=session.confWebSafeKey)) for session in q]
+        has_range = bool(request.earliestStartTime or request.latestStartTime)
+
+        # pick the cheapest form of the type filter: IN runs one sub-query
+        # per type & != two, all merged in memory, while a startTime range
+        # already gives one narrow indexed query to filter types from
+        post_filter = False
+        if len(allowed_session_types) == len(SessionTypes):
+            plan = 'any type'
+        elif len(allowed_session_types) == 1:
+            q = q.filter(Session.typeOfSession == allowed_session_types[0])
+            plan = 'index: typeOfSession = %s' % allowed_session_types[0]
+        elif has_range:
+            post_filter = True
+            plan = 'in memory: typeOfSession not in %s' % ', '.join(
+                sorted(str(t) for t in disallowed_session_types))
+        elif len(disallowed_session_types) == 1:
+            disallowed = list(disallowed_session_types)[0]
+            q = q.filter(Session.typeOfSession != disallowed)
+            plan = 'index: typeOfSession != %s (2 sub-queries)' % disallowed
+        else:
+            q = q.filter(Session.typeOfSession.IN(allowed_session_types))
+            plan = 'index: typeOfSession IN (%d sub-queries)' % len(allowed_session_types)
+        if has_range:
+            plan = 'index: startTime range; ' + plan
+        logging.debug('querySessionsByTypeByStartTime plan: %s', plan)
+
+        # run the query once and reuse the batch for the conference
+        # name lookup and the forms
+        sessions = _fetchEntitiesAsync(q).get_result()
+        if post_filter:
+            sessions = [s for s in sessions
+                if s.typeOfSession not in disallowed_session_types]
+        conf_keys = [(ndb.Key(urlsafe=session.confWebSafeKey)) for session in sessions]
         confs = ndb.get_multi(conf_keys)
         names = {}
         for i in range(len(confs)):
             names[conf_keys[i].urlsafe()] = confs[i].name
 
         items = []
-        for s in q:
+        for s in sessions:
             items.append(self._copySessionToForm(s, names[s.confWebSafeKey]))
-        return SessionForms(items=items)
+        return SessionForms(items=items, queryPlan=plan)
 
 
     @endpoints.method(SessionQueryByTypeByStartTimeForm, SessionForms,
@@ -983,11 +1125,11 @@ class ConferenceApi(remote.Service):
     def getFeaturedSpeaker(self, request):
         """Get latest featured Speakers' list from memcache a conference"""
         #memache key is 'FSP_' + websafeConferenceKey
-        featured_speaker = memcache.get('FSP_' + request.websafeConferenceKey)
-        # print "=== featured_speakers", featured_speaker
-        if not featured_speaker:
-            featured_speaker = FeatureSpeakerForm()
-        return featured_speaker
+        # recomputed by one request at a time if memcache has lost it
+        wsck = request.websafeConferenceKey
+        return getFresh('FSP_' + wsck,
+            lambda: self._featuredSpeaker(wsck), FEATURED_SPEAKER_TTL,
+            default=FeatureSpeakerForm())
 
 
 
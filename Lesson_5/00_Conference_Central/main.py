@@ -48,6 +48,7 @@ from google.appengine.api import app_identity
 from google.appengine.api import mail
 
 from conference import ConferenceApi
+from search import applyQueuedChanges
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -78,9 +79,15 @@ class SetFeaturedSpeakersHandler(webapp2.RequestHandler):
             self.request.get('speakerName'),
             self.request.get('sessionName'))
 
+class UpdateSearchIndexHandler(webapp2.RequestHandler):
+    def post(self):
+        """Retry search term updates that failed during a write."""
+        applyQueuedChanges(self.request.body)
+
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/cache_feature_speaker', SetFeaturedSpeakersHandler),
+    ('/tasks/update_search_index', UpdateSearchIndexHandler),
 ], debug=True)
\ No newline at end of file
@@ -30,6 +30,11 @@ class Profile(ndb.Model):
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionsWishList = ndb.StringProperty(repeated=True)
 
+class EmailUserId(ndb.Model):
+    """EmailUserId -- user id for the "custom" id_type, keyed by
+    normalized email"""
+    userId          = ndb.StringProperty(required=True, indexed=False)
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -130,6 +135,11 @@ class Session(ndb.Model):
     startTime       = ndb.TimeProperty()
     confWebSafeKey  = ndb.StringProperty()
     creatorUserId   = ndb.StringProperty()
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class SearchTerm(ndb.Model):
+    """SearchTerm -- search postings of one term for one kind"""
+    postings        = ndb.JsonProperty(compressed=True) # websafe key -> weight
 
 class SessionPostForm(messages.Message):
     """Session post form """
@@ -160,6 +170,7 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms - multiple sessions outbound message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    queryPlan = messages.StringField(2)
 
 ## query for session's startTime between startTime and endTime
 class SessionQueryByTypeByStartTimeForm(messages.Message):
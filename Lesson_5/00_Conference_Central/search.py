@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+search.py -- Udacity conference server-side Python App Engine
+    keyword search over conference & session text
+
+Text is split into lower-cased word terms. For every kind, each term
+has one SearchTerm root entity holding its postings, a dict of
+websafe key -> weight. A search only reads the entities of its own
+terms, so its cost depends on the query, not on how many documents are
+indexed. Documents matching more query terms rank first, then by summed
+term weight, with rarer terms counting for more.
+
+Writers pass a document's terms from before and after a change to
+updateIndex(); the postings change once the write commits. Indexing
+never fails the write itself: terms whose update fails are handed to a
+task, which the task queue retries until they are stored.
+
+"""
+
+import json
+import logging
+import math
+import re
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SearchTerm
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_QUERY_TERMS = 10
+MAX_DOCUMENT_TERMS = 200
+# keeps a SearchTerm well under the 1MB entity limit; the lowest
+# weighted postings of very common terms are dropped
+MAX_POSTINGS = 5000
+# queued retries stay under the 100KB push task limit
+MAX_TASK_PAYLOAD = 90 * 1024    # bytes
+
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with',
+))
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the search terms in text, in order."""
+    return [word for word in _WORD_RE.findall((text or u'').lower())
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+def documentTerms(fields):
+    """Return {term: weight} for a document given (text, boost) pairs;
+    text may be a string or a list of strings."""
+    terms = {}
+    for text, boost in fields:
+        if isinstance(text, (list, tuple)):
+            text = u' '.join(text)
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + boost
+    if len(terms) > MAX_DOCUMENT_TERMS:
+        kept = sorted(terms, key=terms.get, reverse=True)[:MAX_DOCUMENT_TERMS]
+        terms = dict((term, terms[term]) for term in kept)
+    return terms
+
+
+def _termKey(kind, term):
+    """Return the SearchTerm key for term in kind's index."""
+    return ndb.Key(SearchTerm, '%s:%s' % (kind, term))
+
+
+@ndb.transactional_tasklet
+def _updatePostings(kind, term, changes):
+    """Apply {websafe key: weight or None} to one term's postings."""
+    key = _termKey(kind, term)
+    entity = yield key.get_async()
+    postings = entity.postings if entity else {}
+    for doc, weight in changes.items():
+        if weight:
+            postings[doc] = weight
+        else:
+            postings.pop(doc, None)
+    if not postings:
+        if entity:
+            yield key.delete_async()
+        return
+    if len(postings) > MAX_POSTINGS:
+        kept = sorted(postings, key=postings.get, reverse=True)[:MAX_POSTINGS]
+        postings = dict((doc, postings[doc]) for doc in kept)
+    yield SearchTerm(key=key, postings=postings).put_async()
+
+
+def _applyChanges(kind, by_term):
+    """Write postings changes, one small transaction per term; return
+    {term: changes} of the ones that failed."""
+    futures = [(term, _updatePostings(kind, term, changes))
+               for term, changes in by_term.items()]
+    failed = {}
+    for term, future in futures:
+        try:
+            future.get_result()
+        except Exception:
+            logging.exception('Updating %s search term %r failed', kind, term)
+            failed[term] = by_term[term]
+    return failed
+
+
+def _changeBatches(by_term):
+    """Split {term: changes} into dicts whose JSON fits in one task;
+    a very common term is split across several."""
+    batch, size = {}, 0
+    for term, changes in by_term.items():
+        for doc, weight in changes.items():
+            # over-estimates, as the term is only written once per batch
+            item = len(json.dumps([term, doc, weight]))
+            if batch and size + item > MAX_TASK_PAYLOAD:
+                yield batch
+                batch, size = {}, 0
+            batch.setdefault(term, {})[doc] = weight
+            size += item
+    if batch:
+        yield batch
+
+
+def _applyOrQueueChanges(kind, by_term):
+    """Write postings changes; queue the failed ones for a retry."""
+    failed = _applyChanges(kind, by_term)
+    for batch in _changeBatches(failed):
+        try:
+            taskqueue.add(url='/tasks/update_search_index',
+                payload=json.dumps({'kind': kind, 'changes': batch})
+            )
+        except Exception:
+            # the write is stored already; only these search terms are lost
+            logging.exception('Queueing %d %s search terms failed',
+                              len(batch), kind)
+
+
+def applyQueuedChanges(payload):
+    """Write postings changes queued by a failed update; raise so the
+    task is retried if any of them fail again."""
+    queued = json.loads(payload)
+    failed = _applyChanges(queued['kind'], queued['changes'])
+    if failed:
+        raise RuntimeError('%d search terms not updated' % len(failed))
+
+
+def updateIndex(kind, documents):
+    """Reindex (key, terms before, terms after) documents of kind; either
+    terms dict may be None. Deferred until commit in a transaction."""
+    by_term = {}
+    for key, before, after in documents:
+        before = before or {}
+        after = after or {}
+        doc = key.urlsafe()
+        for term in set(before) | set(after):
+            if before.get(term) != after.get(term):
+                by_term.setdefault(term, {})[doc] = after.get(term)
+    if by_term:
+        ndb.get_context().call_on_commit(
+            lambda: _applyOrQueueChanges(kind, by_term))
+
+
+def search(kind, text, limit=DEFAULT_SEARCH_LIMIT):
+    """Return keys of up to limit kind documents best matching text."""
+    terms = list(set(tokenize(text)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    scores = {}
+    for entity in ndb.get_multi([_termKey(kind, term) for term in terms]):
+        if not entity:
+            continue
+        rarity = 1.0 / math.log(2 + len(entity.postings))
+        for doc, weight in entity.postings.items():
+            matched, score = scores.get(doc, (0, 0.0))
+            scores[doc] = (matched + 1, score + weight * rarity)
+
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [ndb.Key(urlsafe=doc) for doc in ranked]
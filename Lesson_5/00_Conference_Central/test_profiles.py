@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+test_profiles.py -- Udacity conference server-side Python App Engine
+    datastore write counts for lazily created profiles
+
+Run with the App Engine SDK on sys.path:
+    python -m unittest test_profiles
+
+"""
+
+import unittest
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import ConferenceApi
+from models import ConferenceForm
+from models import ConferenceQueryForms
+from models import Profile
+from models import ProfileMiniForm
+from models import TeeShirtSize
+
+
+class ProfileWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        ndb.get_context().clear_cache()
+
+        self.user = users.User('organizer@example.com')
+        self._get_current_user = endpoints.get_current_user
+        endpoints.get_current_user = lambda: self.user
+
+        self.puts = 0
+        def countPuts(service, call, request, response):
+            if call == 'Put':
+                self.puts += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count_puts', countPuts, 'datastore_v3')
+        self.api = ConferenceApi()
+
+    def tearDown(self):
+        endpoints.get_current_user = self._get_current_user
+        self.testbed.deactivate()
+
+    def testGetProfileDoesNotWrite(self):
+        self.api._doProfile()
+        self.api._doProfile()
+        self.assertEqual(self.puts, 0)
+        self.assertIsNone(ndb.Key(Profile, self.user.email()).get())
+
+    def testSaveProfileWritesOnce(self):
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer',
+                                            teeShirtSize=TeeShirtSize.M_M))
+        self.assertEqual(self.puts, 1)
+        prof = ndb.Key(Profile, self.user.email()).get()
+        self.assertEqual(prof.displayName, 'Organizer')
+        self.assertEqual(prof.teeShirtSize, 'M_M')
+
+    def testUnchangedSaveProfileDoesNotWrite(self):
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer'))
+        self.puts = 0
+        self.api._doProfile(ProfileMiniForm(displayName='Organizer'))
+        self.assertEqual(self.puts, 0)
+
+    def testCreateConferenceStoresOrganizerProfile(self):
+        self.api._createConferenceObject(ConferenceForm(name='PyCon'))
+        self.assertIsNotNone(ndb.Key(Profile, self.user.email()).get())
+        # one batch for the Conference & the organizer's Profile
+        self.assertEqual(self.puts, 1)
+
+    def testQueryConferencesWithoutOrganizerProfile(self):
+        self.api._createConferenceObject(ConferenceForm(name='PyCon'))
+        ndb.Key(Profile, self.user.email()).delete()
+        forms = self.api.queryConferences(ConferenceQueryForms())
+        self.assertEqual([f.name for f in forms.items], ['PyCon'])
+        self.assertIsNone(forms.items[0].organizerDisplayName)
+
+
+if __name__ == '__main__':
+    unittest.main()
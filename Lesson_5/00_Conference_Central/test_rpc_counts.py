@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+test_rpc_counts.py -- Udacity conference server-side Python App Engine
+    datastore query counts for conference & session queries
+
+Run with the App Engine SDK on sys.path:
+    python -m unittest test_rpc_counts
+
+"""
+
+import unittest
+from datetime import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import ConferenceApi
+from conference import SESS_GET_BY_SPEAKER_REQUEST
+from models import Conference
+from models import ConferenceQueryForms
+from models import Profile
+from models import Session
+from models import SessionQueryByTypeByStartTimeForm
+from models import SessionTypes
+
+
+class QueryRpcCountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        ndb.get_context().clear_cache()
+
+        organizer = Profile(key=ndb.Key(Profile, 'organizer@example.com'),
+                            displayName='Organizer')
+        speaker = Profile(key=ndb.Key(Profile, 'speaker@example.com'),
+                          displayName='Speaker')
+        confs = [Conference(parent=organizer.key, name='Conf %d' % i,
+                            organizerUserId=organizer.key.id())
+                 for i in range(3)]
+        ndb.put_multi([organizer, speaker] + confs)
+        sessions = [Session(parent=conf.key, name='Talk %d' % i,
+                            speakerUserId=speaker.key.id(),
+                            typeOfSession=SessionTypes.Lecture,
+                            startTime=time(10 + i),
+                            confWebSafeKey=conf.key.urlsafe())
+                    for i, conf in enumerate(confs)]
+        ndb.put_multi(sessions)
+        ndb.get_context().clear_cache()
+
+        self.queries = 0
+        def countQueries(service, call, request, response):
+            if call == 'RunQuery':
+                self.queries += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count_queries', countQueries, 'datastore_v3')
+        self.api = ConferenceApi()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testQueryConferencesRunsQueryOnce(self):
+        forms = self.api.queryConferences(ConferenceQueryForms())
+        self.assertEqual(len(forms.items), 3)
+        self.assertEqual(self.queries, 1)
+
+    def testGetSessionsBySpeakerRunsQueryOnce(self):
+        request = SESS_GET_BY_SPEAKER_REQUEST.combined_message_class(
+            speakerUserId='speaker@example.com')
+        forms = self.api.getSessionsBySpeaker(request)
+        self.assertEqual(len(forms.items), 3)
+        self.assertEqual(self.queries, 1)
+
+    def testQuerySessionsByTypeByStartTimeRunsQueryOnce(self):
+        # one allowed type filters by equality, a single sub-query
+        request = SessionQueryByTypeByStartTimeForm(
+            typeOfSessionDisallowed=[t for t in SessionTypes
+                                     if t != SessionTypes.Lecture])
+        forms = self.api.querySessionsByTypeByStartTime(request)
+        self.assertEqual(len(forms.items), 3)
+        self.assertEqual(self.queries, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
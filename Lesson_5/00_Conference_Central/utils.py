@@ -1,10 +1,66 @@
+import base64
+import hashlib
 import json
+import logging
 import os
+import threading
 import time
+import urllib
 import uuid
+from collections import OrderedDict
 
-from google.appengine.api import urlfetch
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from models import EmailUserId
 from models import Profile
+from settings import WEB_CLIENT_ID
+
+# overridable so a local stand-in server can answer in tests
+TOKENINFO_URL = os.environ.get('TOKENINFO_URL',
+    'https://www.googleapis.com/oauth2/v1/tokeninfo')
+CERTS_URL = os.environ.get('GOOGLE_CERTS_URL',
+    'https://www.googleapis.com/oauth2/v3/certs')
+ID_TOKEN_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# who may present an id_token, as declared on the API in conference.py
+ID_TOKEN_CLIENT_IDS = (WEB_CLIENT_ID, endpoints.API_EXPLORER_CLIENT_ID)
+ID_TOKEN_AUDIENCES = ID_TOKEN_CLIENT_IDS
+
+TOKEN_CACHE_SIZE = 1000         # tokens per instance
+TOKEN_CACHE_TTL = 60 * 60       # seconds, never past the token's expiry
+CERTS_TTL = 60 * 60             # seconds, unless the response says otherwise
+TOKENINFO_RETRIES = 3
+TOKENINFO_BACKOFF = 0.1         # seconds, doubled per retry
+MEMCACHE_TOKEN_KEY = "TOKEN_%s"
+MEMCACHE_CERTS_KEY = "GOOGLE_CERTS"
+USER_ID_CACHE_SIZE = 1000       # email -> user id mappings per instance
+
+_tokens = OrderedDict()         # token hash -> (user id, expires at)
+_tokens_lock = threading.Lock()
+_certs = {}                     # 'keys': {kid: (n, e)}, 'expires': time
+_userIds = OrderedDict()        # normalized email -> user id; never change
+_userIds_lock = threading.Lock()
+
+def formFieldCopier(form_class, model_class, converters=None, names=None):
+    """Return ((field name, converter or None), ...) for the fields of
+    form_class backed by a property of model_class, optionally limited to
+    names. Computed once at import so copying entities to forms needs no
+    per-item reflection."""
+    converters = converters or {}
+    return tuple((field.name, converters.get(field.name))
+                 for field in form_class.all_fields()
+                 if field.name in model_class._properties and
+                 (names is None or field.name in names))
+
+
+def copyToFormValues(entity, copier):
+    """Return dict of form field values for entity using a formFieldCopier."""
+    values = {}
+    for name, convert in copier:
+        value = getattr(entity, name)
+        values[name] = convert(value) if convert else value
+    return values
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -14,32 +70,186 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _tokenUserIdAsync(token).get_result()
 
     if id_type == "custom":
-        # implement your own user_id creation and getting algorythm
-        # this is just a sample that queries datastore for an existing profile
-        # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
+        return _customUserId(user.email())
+
+
+def _b64decode(segment):
+    """Decode unpadded base64url, as used in JWTs."""
+    return base64.urlsafe_b64decode(str(segment) + '=' * (-len(segment) % 4))
+
+
+def _rememberToken(token_hash, user_id, expires_at):
+    """Store a verified token in the instance LRU."""
+    with _tokens_lock:
+        _tokens.pop(token_hash, None)
+        _tokens[token_hash] = (user_id, expires_at)
+        while len(_tokens) > TOKEN_CACHE_SIZE:
+            _tokens.popitem(last=False)
+
+
+@ndb.tasklet
+def _getSigningKeys():
+    """Return Google's id_token signing keys as {kid: (n, e)}."""
+    if _certs.get('expires', 0) > time.time():
+        raise ndb.Return(_certs['keys'])
+    keys = memcache.get(MEMCACHE_CERTS_KEY)
+    ttl = CERTS_TTL
+    if keys is None:
+        resp = yield ndb.get_context().urlfetch(CERTS_URL)
+        if resp.status_code != 200:
+            raise ndb.Return({})
+        keys = {}
+        for jwk in json.loads(resp.content).get('keys', []):
+            keys[jwk['kid']] = (
+                long(_b64decode(jwk['n']).encode('hex'), 16),
+                long(_b64decode(jwk['e']).encode('hex'), 16))
+        # Google rotates keys; honour its max-age
+        for directive in resp.headers.get('cache-control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'max-age' and value.isdigit():
+                ttl = int(value)
+        memcache.set(MEMCACHE_CERTS_KEY, keys, time=ttl)
+    _certs['keys'] = keys
+    _certs['expires'] = time.time() + ttl
+    raise ndb.Return(keys)
+
+
+@ndb.tasklet
+def _verifyIdToken(token):
+    """Return the claims of a Google id_token verified against the
+    signing keys, {} if it was issued for another app, or None if it
+    can't be verified locally."""
+    try:
+        from Crypto.Hash import SHA256
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
+    except ImportError:
+        raise ndb.Return(None)
+    try:
+        header, payload, signature = token.split('.')
+        kid = json.loads(_b64decode(header)).get('kid')
+        claims = json.loads(_b64decode(payload))
+        signature = _b64decode(signature)
+    except (ValueError, TypeError):
+        raise ndb.Return(None)
+
+    keys = yield _getSigningKeys()
+    if kid not in keys:
+        raise ndb.Return(None)
+    verifier = PKCS1_v1_5.new(RSA.construct(keys[kid]))
+    if not verifier.verify(SHA256.new('%s.%s' % (header, payload)), signature):
+        raise ndb.Return(None)
+    if claims.get('iss') not in ID_TOKEN_ISSUERS or \
+            claims.get('exp', 0) <= time.time():
+        raise ndb.Return(None)
+    # a genuine token minted for some other client must not sign in here;
+    # azp may be left out when it equals aud
+    client_id = claims.get('azp', claims.get('aud'))
+    if claims.get('aud') not in ID_TOKEN_AUDIENCES or \
+            client_id not in ID_TOKEN_CLIENT_IDS:
+        logging.warning('Rejected id_token for client %s', client_id)
+        raise ndb.Return({})
+    raise ndb.Return(claims)
+
+
+@ndb.tasklet
+def _fetchTokenInfo(token):
+    """Return tokeninfo for token, retrying transient errors with a
+    backoff that yields to other tasklets instead of blocking."""
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    wait = TOKENINFO_BACKOFF
+    for i in range(TOKENINFO_RETRIES):
+        url = '%s?%s' % (TOKENINFO_URL, urllib.urlencode({token_type: token}))
+        resp = yield ndb.get_context().urlfetch(url)
+        if resp.status_code == 200:
+            raise ndb.Return(json.loads(resp.content))
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            if token_type == 'access_token':
+                break
+            token_type = 'access_token'
         else:
-            return str(uuid.uuid1().get_hex())
+            yield ndb.sleep(wait)
+            wait *= 2
+    logging.warning('tokeninfo failed with status %d', resp.status_code)
+    raise ndb.Return({})
+
+
+@ndb.tasklet
+def _tokenUserIdAsync(token):
+    """Return the user id for an OAuth token, from the instance LRU,
+    memcache, local id_token verification or tokeninfo, in that order."""
+    token_hash = hashlib.sha256(token).hexdigest()
+    with _tokens_lock:
+        cached = _tokens.get(token_hash)
+    if cached and cached[1] > time.time():
+        raise ndb.Return(cached[0])
+
+    cached = memcache.get(MEMCACHE_TOKEN_KEY % token_hash)
+    if cached:
+        _rememberToken(token_hash, *cached)
+        raise ndb.Return(cached[0])
+
+    user_id = ''
+    expires_at = time.time()
+    claims = None
+    if token.count('.') == 2:
+        claims = yield _verifyIdToken(token)
+    if claims is not None:
+        # rejected tokens get no user id and aren't cached
+        user_id = claims.get('sub', '')
+        expires_at = claims.get('exp', expires_at)
+    else:
+        info = yield _fetchTokenInfo(token)
+        user_id = info.get('user_id', '')
+        expires_at += int(info.get('expires_in', 0))
+
+    ttl = int(min(expires_at - time.time(), TOKEN_CACHE_TTL))
+    if user_id and ttl > 0:
+        expires_at = time.time() + ttl
+        _rememberToken(token_hash, user_id, expires_at)
+        memcache.set(MEMCACHE_TOKEN_KEY % token_hash,
+                     (user_id, expires_at), time=ttl)
+    raise ndb.Return(user_id)
+
+
+@ndb.transactional
+def _createEmailUserId(key, user_id):
+    """Store the user id for an email unless another request did first;
+    return the stored mapping."""
+    mapping = key.get()
+    if not mapping:
+        mapping = EmailUserId(key=key, userId=user_id)
+        mapping.put()
+    return mapping
+
+
+def _customUserId(email):
+    """Return the user id mapped to email, creating the mapping once."""
+    email = email.strip()
+    normalized = email.lower()
+    with _userIds_lock:
+        user_id = _userIds.pop(normalized, None)
+        if user_id:
+            _userIds[normalized] = user_id
+            return user_id
+
+    key = ndb.Key(EmailUserId, normalized)
+    mapping = key.get()
+    if not mapping:
+        # keep the id of a Profile created before mappings existed; its
+        # mainEmail has the case user.email() had, not the normalized one
+        profile = Profile.query(Profile.mainEmail.IN(
+            sorted(set([email, normalized])))).get(keys_only=True)
+        user_id = profile.id() if profile else uuid.uuid1().get_hex()
+        mapping = _createEmailUserId(key, user_id)
+
+    with _userIds_lock:
+        _userIds[normalized] = mapping.userId
+        while len(_userIds) > USER_ID_CACHE_SIZE:
+            _userIds.popitem(last=False)
+    return mapping.userId